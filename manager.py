@@ -15,45 +15,323 @@
 import copy
 import os
 import random
+import re
 import sys
 import math
 import sqlite3
 import argparse
+import array
+import bisect
+import codecs
+import collections
+import contextlib
 import datetime
+import gzip
+import hashlib
+import heapq
+import itertools
+import queue
+import secrets
+import shlex
 import shutil
-import skills
+import signal
+import threading
+import time
 import json
-from skills import trueskill
-from subprocess import Popen, PIPE, call
+import operator
+import urllib.parse
+import zlib
+from subprocess import Popen, PIPE, TimeoutExpired, list2cmdline
 
 
 halite_command = "./halite"
 replay_dir = "replays"
 # db_filename is now specified at command line, with the default set to "db.sqlite3"
 browser_binary = "firefox"
+default_map_widths = [312, 264, 336, 240, 360, 384]    # heights are 2/3 of the width
+
+def percentile(values, q):
+    """ Nearest-rank percentile of an already sorted list """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(math.ceil(q / 100.0 * len(values))) - 1))]
+
+def bot_fingerprint(command):
+    """ Hash of a bot (or engine) command line together with the contents of every file it names;
+    for the bot's own files (see bot_files) that is everything bot_file_set puts with them """
+    digest = hashlib.sha256(command.encode())
+    tokens = shlex.split(command, posix=(os.name != 'nt'))
+    own = bot_files(tokens)
+    for token in tokens:
+        if token in own:
+            content_digest(*bot_file_set(token), digest=digest)
+        elif os.path.isfile(token):
+            content_digest(os.path.dirname(os.path.abspath(token)), [os.path.basename(token)], digest=digest)
+    return digest.hexdigest()
+
+def bot_files(tokens):
+    """ The tokens of a bot command that name the bot's own files.  A program found through PATH
+    is not one of them, and neither is the program the command starts when later tokens name
+    files too: it is the interpreter running them (as in "/usr/bin/python3 bots/a/MyBot.py"). """
+    def on_path(token):
+        found = shutil.which(os.path.basename(token))
+        return found is not None and os.path.samefile(found, token)
+    files = [token for token in tokens if os.path.isfile(token) and not on_path(token)]
+    if len(files) > 1 and files[0] == tokens[0]:
+        files = files[1:]
+    return files
+
+bot_directory_limit = 64 << 20     # bytes; a bigger bot directory isn't staged or fingerprinted whole
+
+def bot_file_set(path):
+    """ The directory of a bot file and the files in it (relative paths) that make up the bot:
+    the whole directory, leaving out replays, logs and hidden files, unless it is the directory
+    the manager runs in (or contains it) or is bigger than bot_directory_limit; then only the
+    file itself, plus its sibling modules for a Python bot """
+    path = os.path.abspath(path)
+    source = os.path.dirname(path)
+    cwd = os.getcwd()
+    if not (cwd == source or cwd.startswith(source + os.sep)):
+        files, total = [], 0
+        for root, directories, names in os.walk(source):
+            directories[:] = [name for name in directories if not name.startswith(".") and name != "__pycache__"]
+            for name in names:
+                if name.startswith(".") or name.endswith((".hlt", ".log")) or ".hlt." in name:
+                    continue
+                files.append(os.path.relpath(os.path.join(root, name), source))
+                total += os.path.getsize(os.path.join(root, name))
+            if total > bot_directory_limit:
+                print("%s holds more than %d MB besides replays and logs; only taking %s and its sibling modules" % (source, bot_directory_limit >> 20, os.path.basename(path)))
+                break
+        else:
+            return source, sorted(files)
+    siblings = [name for name in os.listdir(source) if name.endswith(".py")] if path.endswith(".py") else []
+    return source, sorted(set(siblings + [os.path.basename(path)]))
+
+def content_digest(source, files, digest=None):
+    """ sha256 over the names and contents of files (relative to source), added to digest if given """
+    digest = digest or hashlib.sha256()
+    for name in files:
+        digest.update(name.encode() + b"\0")
+        with open(os.path.join(source, name), 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest
 
 def max_match_rounds(width, height):
     return math.sqrt(width * height) * 10.0
 
-def update_skills(players, ranks):
+def update_skills(players, ranks, engine):
     """ Update player skills based on ranks from a match """
-    teams = [skills.Team({player.name: skills.GaussianRating(player.mu, player.sigma)}) for player in players]
-    match = skills.Match(teams, ranks)
-    calc = trueskill.FactorGraphTrueSkillCalculator()
-    game_info = trueskill.TrueSkillGameInfo()
-    updated = calc.new_ratings(match, game_info)
+    updated = engine.rate([(player.mu, player.sigma) for player in players], ranks)
     print ("Updating ranks")
-    for team in updated:
-        player_name, skill_data = next(iter(team.items()))    #in Halite, teams will always be a team of one player
-        player = next(player for player in players if player.name == str(player_name))   #this suggests that players should be a dictionary instead of a list
-        player.mu = skill_data.mean
-        player.sigma = skill_data.stdev
+    for player, (mu, sigma) in zip(players, updated):
+        player.mu = mu
+        player.sigma = sigma
         player.update_skill()
-        print("skill = %4f  mu = %3f  sigma = %3f  name = %s" % (player.skill, player.mu, player.sigma, str(player_name)))
+        print("skill = %4f  mu = %3f  sigma = %3f  name = %s" % (player.skill, player.mu, player.sigma, player.name))
+
+
+class SkillsRatingEngine:
+    """ TrueSkill from the skills package: the reference implementation """
+    def __init__(self, beta=25.0 / 6.0, tau=25.0 / 300.0, draw_probability=0.10):
+        import skills
+        from skills import trueskill
+        self.skills = skills
+        self.calc = trueskill.FactorGraphTrueSkillCalculator()
+        self.game_info = trueskill.TrueSkillGameInfo(beta=beta, dynamics_factor=tau, draw_probability=draw_probability)
+
+    def rate(self, ratings, ranks):
+        """ New (mu, sigma) for each (mu, sigma) in ratings, given the finishing ranks (1 = winner) """
+        teams = [self.skills.Team({i: self.skills.GaussianRating(mu, sigma)}) for i, (mu, sigma) in enumerate(ratings)]
+        updated = self.calc.new_ratings(self.skills.Match(teams, list(ranks)), self.game_info)
+        new_ratings = [None] * len(ratings)
+        for team in updated:
+            player, skill_data = next(iter(team.items()))    #in Halite, teams will always be a team of one player
+            new_ratings[player.player_id] = (skill_data.mean, skill_data.stdev)
+        return new_ratings
+
+
+def gaussian_pdf(x):
+    return math.exp(-0.5 * x * x) / math.sqrt(2 * math.pi)
+
+def gaussian_cdf(x):
+    return 0.5 * math.erfc(-x / math.sqrt(2))
+
+
+class FastRatingEngine:
+    """ The same TrueSkill factor graph, specialised for free-for-all games with one player per
+    team.  Messages are plain (precision, precision * mean) pairs along the chain of adjacent
+    finishing positions, and a two player game is a single closed-form step. """
+    tiny = 2.222758749e-162
+
+    def __init__(self, beta=25.0 / 6.0, tau=25.0 / 300.0, draw_probability=0.10, max_delta=0.0001, max_sweeps=100):
+        self.beta = beta
+        self.tau = tau
+        from statistics import NormalDist
+        self.draw_margin = NormalDist().inv_cdf(0.5 * (draw_probability + 1)) * math.sqrt(2) * beta
+        self.max_delta = max_delta
+        self.max_sweeps = max_sweeps
+
+    def rate(self, ratings, ranks):
+        """ New (mu, sigma) for each (mu, sigma) in ratings, given the finishing ranks (1 = winner) """
+        n = len(ratings)
+        order = sorted(range(n), key=lambda i: ranks[i])
+        beta2 = self.beta ** 2
+        tau2 = self.tau ** 2
+        prior = []      # performance priors in finishing order
+        for i in order:
+            mu, sigma = ratings[i]
+            var = sigma ** 2 + tau2 + beta2
+            prior.append((1.0 / var, mu / var))
+        up = [(0.0, 0.0)] * n       # up[k]: from difference k to the performance at position k
+        down = [(0.0, 0.0)] * n     # down[k]: from difference k to the performance at position k + 1
+        trunc = [(0.0, 0.0)] * (n - 1)
+        draws = [ranks[order[k]] == ranks[order[k + 1]] for k in range(n - 1)]
+        schedule = list(range(n - 1)) + list(range(n - 3, 0, -1))
+        for _ in range(self.max_sweeps):
+            delta = 0.0
+            for k in schedule:
+                delta = max(delta, self.update_difference(k, prior, up, down, trunc, draws[k]))
+            if n == 2 or delta <= self.max_delta:
+                break
+        new_ratings = [None] * n
+        for position, i in enumerate(order):
+            mu, sigma = ratings[i]
+            var = sigma ** 2 + tau2
+            pi = 1.0 / var
+            tau = mu / var
+            # the evidence on this performance, passed back through the performance noise
+            evidence_pi = up[position][0] + (down[position - 1][0] if position else 0.0)
+            evidence_tau = up[position][1] + (down[position - 1][1] if position else 0.0)
+            if evidence_pi > 0.0:
+                message_var = 1.0 / evidence_pi + beta2
+                pi += 1.0 / message_var
+                tau += (evidence_tau / evidence_pi) / message_var
+            new_ratings[i] = (tau / pi, math.sqrt(1.0 / pi))
+        return new_ratings
+
+    def update_difference(self, k, prior, up, down, trunc, draw):
+        """ One round of messages through the difference between positions k and k + 1 """
+        pi_a = prior[k][0] + (down[k - 1][0] if k else 0.0)
+        tau_a = prior[k][1] + (down[k - 1][1] if k else 0.0)
+        pi_b = prior[k + 1][0] + up[k + 1][0]
+        tau_b = prior[k + 1][1] + up[k + 1][1]
+        var_a, mean_a = 1.0 / pi_a, tau_a / pi_a
+        var_b, mean_b = 1.0 / pi_b, tau_b / pi_b
+        c = 1.0 / (var_a + var_b)
+        d = (mean_a - mean_b) * c
+        sqrt_c = math.sqrt(c)
+        v, w = (self.within_margin if draw else self.exceeds_margin)(d / sqrt_c, self.draw_margin * sqrt_c)
+        denominator = 1.0 - w
+        new_pi = c / denominator - c
+        new_tau = (d + sqrt_c * v) / denominator - d
+        old_pi, old_tau = trunc[k]
+        trunc[k] = (new_pi, new_tau)
+        var_t, mean_t = 1.0 / new_pi, new_tau / new_pi
+        up[k] = (1.0 / (var_t + var_b), (mean_t + mean_b) / (var_t + var_b))
+        down[k] = (1.0 / (var_a + var_t), (mean_a - mean_t) / (var_a + var_t))
+        return max(abs(new_tau - old_tau), math.sqrt(abs(new_pi - old_pi)))
+
+    def exceeds_margin(self, t, e):
+        denominator = gaussian_cdf(t - e)
+        if denominator < self.tiny:
+            return -t + e, (1.0 if t < 0.0 else 0.0)
+        v = gaussian_pdf(t - e) / denominator
+        return v, v * (v + t - e)
+
+    def within_margin(self, t, e):
+        t_abs = abs(t)
+        denominator = gaussian_cdf(e - t_abs) - gaussian_cdf(-e - t_abs)
+        if denominator < self.tiny:
+            return (-t - e if t < 0.0 else -t + e), 1.0
+        v = (gaussian_pdf(-e - t_abs) - gaussian_pdf(e - t_abs)) / denominator
+        w = v ** 2 + ((e - t_abs) * gaussian_pdf(e - t_abs) - (-e - t_abs) * gaussian_pdf(-e - t_abs)) / denominator
+        return (-v if t < 0.0 else v), w
+
+
+rating_engines = {"skills": SkillsRatingEngine, "fast": FastRatingEngine}
+
+def check_rating_engines(games=200, seed=1):
+    """ Rate the same random games with both engines and report how far apart they are """
+    reference, fast = SkillsRatingEngine(), FastRatingEngine()
+    rng = random.Random(seed)
+    worst_mu = worst_sigma = 0.0
+    for _ in range(games):
+        n = rng.randint(2, 6)
+        ratings = [(rng.uniform(10.0, 40.0), rng.uniform(0.5, 25.0 / 3.0)) for _ in range(n)]
+        ranks = list(range(1, n + 1))
+        rng.shuffle(ranks)
+        if rng.random() < 0.1:
+            ranks[ranks.index(2)] = 1
+        for (mu1, sigma1), (mu2, sigma2) in zip(reference.rate(ratings, ranks), fast.rate(ratings, ranks)):
+            worst_mu = max(worst_mu, abs(mu1 - mu2))
+            worst_sigma = max(worst_sigma, abs(sigma1 - sigma2))
+    print("Compared %d random games: largest difference mu %.6f, sigma %.6f" % (games, worst_mu, worst_sigma))
+    return worst_mu, worst_sigma
+
+
+def score_from_elo(elo):
+    """ Expected score of a player elo points stronger than its opponent """
+    return 1.0 / (1.0 + 10.0 ** (-elo / 400.0))
+
+def elo_from_score(score):
+    """ The Elo difference that gives an expected score of score """
+    score = min(max(score, 1e-6), 1.0 - 1e-6)
+    return -400.0 * math.log10(1.0 / score - 1.0)
+
+
+class SequentialTest:
+    """ Sequential probability ratio test of H0: A is elo0 stronger than B, against H1: A is elo1
+    stronger.  Each sample is a pair of games on the same map with the seats swapped, scored
+    from A's side as 0, 0.25, 0.5, 0.75 or 1, which cancels out most of the luck of the map.
+    The log-likelihood ratio uses the usual normal approximation.  One imaginary pair, spread
+    evenly over the outcomes, keeps the variance sane while only a few pairs have been played. """
+    outcomes = (0.0, 0.25, 0.5, 0.75, 1.0)
+
+    def __init__(self, elo0=0.0, elo1=30.0, alpha=0.05, beta=0.05):
+        self.elo0 = elo0
+        self.elo1 = elo1
+        self.lower = math.log(beta / (1.0 - alpha))
+        self.upper = math.log((1.0 - beta) / alpha)
+        self.counts = [0] * len(self.outcomes)
+
+    def add(self, pair_score):
+        self.counts[self.outcomes.index(pair_score)] += 1
+
+    def pairs(self):
+        return sum(self.counts)
+
+    def mean_variance(self):
+        counts = [count + 1.0 / len(self.outcomes) for count in self.counts]
+        total = sum(counts)
+        mean = sum(count * x for count, x in zip(counts, self.outcomes)) / total
+        variance = sum(count * (x - mean) ** 2 for count, x in zip(counts, self.outcomes)) / total
+        return mean, variance
+
+    def llr(self):
+        mean, variance = self.mean_variance()
+        s0, s1 = score_from_elo(self.elo0), score_from_elo(self.elo1)
+        return self.pairs() * (s1 - s0) * (2.0 * mean - s0 - s1) / (2.0 * variance)
+
+    def result(self):
+        """ "H1" or "H0" once the test is decided, None while it is not """
+        llr = self.llr()
+        if llr >= self.upper:
+            return "H1"
+        if llr <= self.lower:
+            return "H0"
+        return None
+
+    def elo(self, z=1.96):
+        """ Estimated Elo difference with its confidence interval (95% by default) """
+        mean, variance = self.mean_variance()
+        margin = z * math.sqrt(variance / max(1, self.pairs()))
+        return elo_from_score(mean), elo_from_score(mean - margin), elo_from_score(mean + margin)
 
 
 class Match:
-    def __init__(self, players, width, height, seed, time_limit, keep_replays):
+    def __init__(self, players, width, height, seed, time_limit, replay_store):
         self.map_seed = seed
         self.width = width
         self.height = height
@@ -67,7 +345,20 @@ class Match:
         self.total_time_limit = time_limit
         self.timeouts = []
         self.num_players = len(players)
-        self.keep_replay = keep_replays
+        self.replay_store = replay_store
+        self.replay_size = None
+        self.stored_size = None
+        self.status = "ok"
+        self.cached = False
+        self.cache_key = None
+        self.replay_time = None
+        self.wall_time = None
+        self.cpu_time = None
+        self.peak_rss = None
+        self.bot_usage = None
+        self.cpus = None
+        self.taskset = None
+        self.queue_id = None
 
     def __repr__(self):
         title1 = "Match between " + ", ".join([p.name for p in self.players]) + "\n"
@@ -84,20 +375,119 @@ class Match:
         result = [halite_binary, dims, quiet, seed]
         return result + self.paths
 
-    def run_match(self, halite_binary):
+    def launch_command(self, halite_binary):
+        """ The command to start, under taskset when the match is pinned to CPUs and taskset is installed """
         command = self.get_command(halite_binary)
-        p = Popen(command, stdin=None, stdout=PIPE, stderr=None)
-        results, _ = p.communicate(None, self.total_time_limit)
+        if self.cpus and self.taskset:
+            return [self.taskset, "-c", ",".join(str(cpu) for cpu in self.cpus)] + command
+        return command
+
+    def run_match(self, halite_binary):
+        if self.cached:
+            return
+        command = self.launch_command(halite_binary)
+        start = time.monotonic()
+        p = Popen(command, stdin=None, stdout=PIPE, stderr=None, start_new_session=True)
+        self.pin_cpus(p.pid)
+        with ProcessMonitor(p.pid, self.num_players) as monitor:
+            try:
+                results, _ = p.communicate(None, self.total_time_limit)
+            except TimeoutExpired:
+                self.kill_match(p)
+                p.communicate()
+                results = None
+        self.record_usage(monitor, time.monotonic() - start)
+        if results is None:
+            self.time_out()
+            return
+        self.finish_match(results, p.returncode)
+        self.store_replay()
+
+    async def run_match_async(self, halite_binary):
+        import asyncio
+        if self.cached:
+            return
+        command = self.launch_command(halite_binary)
+        start = time.monotonic()
+        p = await asyncio.create_subprocess_exec(*command, stdin=None, stdout=PIPE, stderr=None, start_new_session=True)
+        self.pin_cpus(p.pid)
+        with ProcessMonitor(p.pid, self.num_players) as monitor:
+            try:
+                results, _ = await asyncio.wait_for(p.communicate(), self.total_time_limit)
+            except asyncio.TimeoutError:
+                self.kill_match(p)
+                await p.wait()
+                results = None
+        self.record_usage(monitor, time.monotonic() - start)
+        if results is None:
+            self.time_out()
+            return
+        self.finish_match(results, p.returncode)
+        await asyncio.get_running_loop().run_in_executor(None, self.store_replay)
+
+    @staticmethod
+    def kill_match(p):
+        """ Kill halite and every bot it started: they all share halite's process group """
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(p.pid, signal.SIGKILL)
+            else:
+                p.kill()
+        except ProcessLookupError:
+            pass
+
+    def time_out(self):
+        """ Record a match that overran its time limit: it has no result, and won't be rated """
+        print("Match timed out after %.0f seconds, killed it" % self.total_time_limit)
+        self.status = "timeout"
+        if self.bot_usage:
+            for usage in self.bot_usage:
+                usage[3] = "timeout"
+
+    def pin_cpus(self, pid):
+        """ Without taskset, pin halite from here once it has started (a preexec_fn isn't safe with
+        the runner and monitor threads).  A bot it launches in that first instant keeps the
+        manager's CPUs. """
+        if self.cpus and not self.taskset:
+            try:
+                os.sched_setaffinity(pid, self.cpus)
+            except ProcessLookupError:
+                pass
+
+    # what finish_round needs from a played match; kept in the match queue until it is applied
+    outcome_fields = ("results", "return_code", "replay_file", "replay_size", "stored_size", "status",
+                      "wall_time", "cpu_time", "peak_rss", "bot_usage", "cached", "cache_key")
+
+    def outcome(self):
+        return {name: getattr(self, name) for name in self.outcome_fields}
+
+    def restore(self, outcome):
+        for name in self.outcome_fields:
+            setattr(self, name, outcome[name])
+
+    def finish_match(self, results, return_code):
         self.results_string = results.decode('ascii')
-        self.return_code = p.returncode
+        self.return_code = return_code
         self.parse_results_string()
-        update_skills(self.players, copy.deepcopy(self.results))
-        if self.keep_replay:
+        if return_code:
+            self.status = "error"
+
+    def record_usage(self, monitor, wall_time):
+        self.wall_time = wall_time
+        self.cpu_time = monitor.total_cpu()
+        self.peak_rss = monitor.peak_rss
+        self.bot_usage = [[bot.wall_time(), bot.cpu_time(), bot.peak_rss, "ok"] for bot in monitor.bots]
+
+    def store_replay(self):
+        start = time.perf_counter()
+        self.archive_replay()
+        self.replay_time = time.perf_counter() - start
+
+    def archive_replay(self):
+        if self.replay_store:
             print("Keeping replay\n")
-            if not os.path.exists(replay_dir):
-                os.makedirs(replay_dir)
             try:
-                shutil.move(self.replay_file, replay_dir)
+                self.replay_file, self.replay_size, self.stored_size = self.replay_store.archive(self.replay_file)
             except Exception as e:
                 print(e)
         else: 
@@ -109,9 +499,11 @@ class Match:
         j = json.loads(self.results_string)
         print(j)
         self.replay_file = j['replay']
-        # TODO Timeout
+        errors = j.get('error_logs') or {}
         for i in range(self.num_players):
             self.results[i] = j['stats'][str(i)]['rank']
+            if self.bot_usage and str(i) in errors:
+                self.bot_usage[i][3] = "error"
         #if len(lines) < (2 + (2 * self.num_players)):
             #raise ValueError("Not enough lines in match output")
         #else:
@@ -127,27 +519,634 @@ class Match:
                     #player_index -= 1   #zero-based indexing
                     #self.results[player_index] = rank
 
+class ProcessMonitor:
+    """ Samples the process tree of a running match from /proc: CPU time, peak resident memory
+    and lifetime, for the engine and for each bot.  Bots are told apart by the order in which
+    the engine starts them, and anything they spawn is charged to them.  On systems without
+    /proc nothing is sampled and the figures stay at zero. """
+    interval = 0.1
+    ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+    page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+    class Bot:
+        __slots__ = ("cpu", "peak_rss", "first_seen", "last_seen")
+
+        def __init__(self):
+            self.cpu = {}
+            self.peak_rss = 0
+            self.first_seen = None
+            self.last_seen = None
+
+        def cpu_time(self):
+            return sum(self.cpu.values())
+
+        def wall_time(self):
+            return (self.last_seen - self.first_seen) if self.first_seen is not None else 0.0
+
+    def __init__(self, pid, num_bots):
+        self.pid = pid
+        self.bots = [self.Bot() for _ in range(num_bots)]
+        self.owner = {}             # pid -> index of the bot it belongs to
+        self.started = 0            # bots started by the engine so far
+        self.engine_cpu = 0.0
+        self.reaped_cpu = 0.0       # children's CPU time the engine has already collected
+        self.peak_rss = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        if os.path.exists("/proc/%d/stat" % self.pid):
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        while True:
+            try:
+                self.sample()
+            except OSError:
+                pass
+            if self.stopping.wait(self.interval):
+                break
+
+    def total_cpu(self):
+        return self.engine_cpu + max(self.reaped_cpu, sum(bot.cpu_time() for bot in self.bots))
+
+    @classmethod
+    def read_stat(cls, pid):
+        """ (parent pid, own cpu seconds, reaped children's cpu seconds, start tick, rss bytes) """
+        with open("/proc/%d/stat" % pid) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        own = (int(fields[11]) + int(fields[12])) / cls.ticks
+        children = (int(fields[13]) + int(fields[14])) / cls.ticks
+        return int(fields[1]), own, children, int(fields[19]), int(fields[21]) * cls.page_size
+
+    @staticmethod
+    def children(pid):
+        found = []
+        try:
+            for task in os.listdir("/proc/%d/task" % pid):
+                with open("/proc/%d/task/%s/children" % (pid, task)) as f:
+                    found.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+        return found
+
+    def sample(self):
+        now = time.monotonic()
+        _, own, reaped, _, rss = self.read_stat(self.pid)
+        self.engine_cpu = own
+        self.reaped_cpu = reaped
+        total_rss = rss
+        direct = []
+        for child in self.children(self.pid):
+            try:
+                direct.append((self.read_stat(child)[3], child))
+            except OSError:
+                pass
+        for _, child in sorted(direct):
+            if child not in self.owner and self.started < len(self.bots):
+                self.owner[child] = self.started
+                self.started += 1
+        pending = [child for _, child in direct]
+        while pending:
+            pid = pending.pop()
+            if pid not in self.owner:
+                continue
+            bot = self.bots[self.owner[pid]]
+            try:
+                _, own, _, _, rss = self.read_stat(pid)
+            except OSError:
+                continue
+            bot.cpu[pid] = own
+            bot.peak_rss = max(bot.peak_rss, rss)
+            if bot.first_seen is None:
+                bot.first_seen = now
+            bot.last_seen = now
+            total_rss += rss
+            for grandchild in self.children(pid):
+                self.owner.setdefault(grandchild, self.owner[pid])
+                pending.append(grandchild)
+        self.peak_rss = max(self.peak_rss, total_rss)
+
+
+class ReplayStore:
+    """ Moves finished replays into a directory, compressing them on the way in.  Files are
+    streamed through the compressor in chunks, so a large replay is never read into memory. """
+    extensions = {"gzip": ".gz", "zstd": ".zst", "none": ""}
+    chunk_size = 1 << 20
+
+    def __init__(self, directory, compression="gzip"):
+        self.directory = directory
+        self.compression = compression
+        if compression == "zstd":
+            import importlib.util
+            if importlib.util.find_spec("zstandard") is None:
+                raise ImportError("zstd replay compression needs the zstandard module (pip install zstandard)")
+
+    def archive(self, filename):
+        """ Store filename; returns (archived path, original size, stored size) """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        size = os.path.getsize(filename)
+        path = os.path.join(self.directory, os.path.basename(filename)) + self.extensions[self.compression]
+        if self.compression == "none":
+            shutil.move(filename, path)
+            return path, size, size
+        with open(filename, 'rb') as source, self.open(path, 'wb') as target:
+            shutil.copyfileobj(source, target, self.chunk_size)
+        os.remove(filename)
+        return path, size, os.path.getsize(path)
+
+    @staticmethod
+    def open(path, mode='rb'):
+        """ Open a replay, compressed or not, picking the codec from the file extension """
+        if path.endswith(".gz"):
+            return gzip.open(path, mode, compresslevel=6)
+        if path.endswith(".zst"):
+            import zstandard
+            if 'w' in mode:
+                return zstandard.open(path, mode, cctx=zstandard.ZstdCompressor(level=10))
+            return zstandard.open(path, mode)
+        return open(path, mode)
+
+    def prune(self, db, keep_days=None, keep_top=None, keep_upsets=False):
+        """ Delete every archived replay that no keep rule asks for.  Rules: played in the last
+        keep_days days, involving one of the keep_top highest ranked bots, or an upset (the winner
+        is currently rated below someone they beat).  Returns the number of replays deleted. """
+        rules = []
+        tup = []
+        if keep_days is not None:
+            rules.append("r.created >= ?")
+            tup.append(time.time() - keep_days * 86400)
+        if keep_top is not None:
+            rules.append("exists (select 1 from games g join players p on p.name=g.name where g.game_id=r.game_id and p.rank <= ?)")
+            tup.append(keep_top)
+        if keep_upsets:
+            rules.append("exists (select 1 from games w join players pw on pw.name=w.name join games l on l.game_id=w.game_id join players pl on pl.name=l.name where w.game_id=r.game_id and w.finish=1 and l.finish>1 and pw.skill<pl.skill)")
+        if not rules:
+            print("No retention rule given, no replays deleted")
+            return 0
+        doomed = db.retrieve("select r.game_id, r.path from replays r where not (" + " or ".join(rules) + ")", tup)
+        for game_id, path in doomed:
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(e)
+        with db.transaction():
+            db.update_many("delete from replays where game_id=?", ((game_id,) for game_id, _ in doomed))
+        db.commit()
+        return len(doomed)
+
+
+class ReplayReader:
+    """ Walks a replay's JSON a chunk at a time, so that a large replay is never held in memory.
+    Values are decoded as they are asked for, skip() steps over the ones that aren't needed,
+    and elements() decodes an array one element (one frame, say) at a time. """
+    chunk_size = 1 << 20
+    decoder = json.JSONDecoder()
+    innermost = re.compile(r'[\[{][^\[\]{}"]*[\]}]')
+
+    def __init__(self, path):
+        self.file = ReplayStore.open(path)
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.file.close()
+
+    def fill(self):
+        """ Drop what has been consumed and read another chunk; False at the end of the file """
+        if self.eof:
+            return False
+        data = self.file.read(self.chunk_size)
+        self.eof = not data
+        self.buffer = self.buffer[self.pos:] + self.text_decoder.decode(data, final=self.eof)
+        self.pos = 0
+        return not self.eof
+
+    def peek(self):
+        """ The next character that isn't white space, without consuming it ('' at the end) """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("expected %r in replay, found %r" % (char, self.peek()))
+        self.pos += 1
+
+    def value(self):
+        """ Decode the next value; meant for ones that fit in memory comfortably """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                if end < len(self.buffer) or self.eof:    # a number could go on in the next chunk
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def skip(self):
+        """ Step over the next value.  While no string is in sight (and in a replay the next
+        key is the first one), everything read so far is shrunk: the innermost arrays become a
+        0, again and again, until even the frames are a few characters long.  Whatever is left
+        once the end of the value has been read is decoded as usual. """
+        while self.peek() == "[" and self.buffer.find('"', self.pos) < 0:
+            rest, collapsed = self.buffer[self.pos:], 1
+            while collapsed:
+                rest, collapsed = self.innermost.subn("0", rest)
+            self.buffer, self.pos = rest, 0
+            if rest[:1] != "[" or not self.fill():
+                break
+        self.value()
+
+    def fields(self):
+        """ Walk the next object: yields each key with the reader positioned on its value, which
+        has to be consumed (value(), skip() or elements()) before the next key is asked for """
+        self.expect("{")
+        while self.peek() != "}":
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.peek() == ",":
+                self.pos += 1
+        self.pos += 1
+
+    def elements(self):
+        """ Walk the next array, decoding one element at a time """
+        self.expect("[")
+        while self.peek() != "]":
+            yield self.value()
+            if self.peek() == ",":
+                self.pos += 1
+        self.pos += 1
+
+
+def analyze_replay(path):
+    """ Territory, strength and production per player and turn, and the turn each player was
+    eliminated, read from a replay in two streaming passes: halite writes the keys in
+    alphabetical order, so the frames come before the productions they have to be weighed by.
+    Returns {"frames": n, "players": [{"territory": array, "strength": array,
+    "production": array, "eliminated": turn or None}, ...]} with players in seat order. """
+    header = {}
+    with ReplayReader(path) as reader:
+        for key in reader.fields():
+            if key in ("frames", "moves"):
+                reader.skip()
+            else:
+                header[key] = reader.value()
+    productions = list(itertools.chain.from_iterable(header["productions"]))
+    players = [{"territory": array.array("i"), "strength": array.array("i"), "production": array.array("i"), "eliminated": None} for _ in range(header["num_players"])]
+    frames = 0
+    with ReplayReader(path) as reader:
+        for key in reader.fields():
+            if key != "frames":
+                reader.skip()
+                continue
+            for frame in reader.elements():
+                # a frame is rows of [owner, strength] cells, in the same order as the productions
+                cells = list(itertools.chain.from_iterable(frame))
+                owners = list(map(operator.itemgetter(0), cells))
+                strengths = list(map(operator.itemgetter(1), cells))
+                for seat, player in enumerate(players, 1):
+                    territory = owners.count(seat)
+                    strength = production = 0
+                    if territory:
+                        mine = list(map(operator.eq, owners, itertools.repeat(seat)))
+                        strength = sum(itertools.compress(strengths, mine))
+                        production = sum(itertools.compress(productions, mine))
+                    elif player["eliminated"] is None:
+                        player["eliminated"] = frames
+                    player["territory"].append(territory)
+                    player["strength"].append(strength)
+                    player["production"].append(production)
+                frames += 1
+    return {"frames": frames, "players": players}
+
+def reference_replay_analysis(path):
+    """ What analyze_replay should return for path, worked out from the whole replay loaded with json """
+    with ReplayStore.open(path) as f:
+        replay = json.load(f)
+    productions = replay["productions"]
+    players = []
+    for seat in range(1, replay["num_players"] + 1):
+        player = {"territory": [], "strength": [], "production": [], "eliminated": None}
+        for turn, frame in enumerate(replay["frames"]):
+            cells = [(cell, y, x) for y, row in enumerate(frame) for x, cell in enumerate(row) if cell[0] == seat]
+            player["territory"].append(len(cells))
+            player["strength"].append(sum(cell[1] for cell, _, _ in cells))
+            player["production"].append(sum(productions[y][x] for _, y, x in cells))
+            if not cells and player["eliminated"] is None:
+                player["eliminated"] = turn
+        players.append(player)
+    return {"frames": len(replay["frames"]), "players": players}
+
+def check_replay_reader(paths=(), chunk_sizes=(7, 100, 1 << 20), seed=1):
+    """ Compare analyze_replay, reading in chunks of each size, against reference_replay_analysis
+    on the given replays, or on a generated one with awkward player names, sorted keys and
+    indentation when there are none.  Returns the number of mismatches. """
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        if not paths:
+            rng = random.Random(seed)
+            width, height, turns = 30, 20, 6
+            replay = {"version": 11, "width": width, "height": height, "num_players": 3, "num_frames": turns,
+                      "player_names": ['a]"[{b\\', "c", " d"], "productions": [[rng.randint(1, 9) for x in range(width)] for y in range(height)],
+                      "frames": [[[[rng.choice([0, 1, 2, 3] if turn < 3 else [0, 1, 2]), rng.randint(0, 255)] for x in range(width)] for y in range(height)] for turn in range(turns)],
+                      "moves": [[[rng.randint(0, 4) for x in range(width)] for y in range(height)] for turn in range(turns - 1)]}
+            paths = [os.path.join(directory, "generated.hlt.gz")]
+            with gzip.open(paths[0], "wt") as f:
+                json.dump(replay, f, sort_keys=True, indent=1)
+        default_chunk_size = ReplayReader.chunk_size
+        mismatches = 0
+        try:
+            for path in paths:
+                expected = reference_replay_analysis(path)
+                for chunk_size in chunk_sizes:
+                    ReplayReader.chunk_size = chunk_size
+                    found = analyze_replay(path)
+                    found["players"] = [dict(player, territory=list(player["territory"]), strength=list(player["strength"]), production=list(player["production"])) for player in found["players"]]
+                    if found != expected:
+                        print("Mismatch reading %s in chunks of %d bytes" % (path, chunk_size))
+                        mismatches += 1
+        finally:
+            ReplayReader.chunk_size = default_chunk_size
+    print("Checked %d replays at chunk sizes %s: %d mismatches" % (len(paths), ", ".join(map(str, chunk_sizes)), mismatches))
+    return mismatches
+
+def analyze_replays(db, jobs=1):
+    """ Analyse every archived replay that has no replay_stats yet, jobs at a time in separate
+    processes, and store the results as they come in """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    pending = db.unanalyzed_replays()
+    print("%d replays to analyse" % len(pending))
+    done = failed = 0
+    with ProcessPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = {pool.submit(analyze_replay, path): (game_id, path, players) for game_id, path, players in pending}
+        for future in as_completed(futures):
+            game_id, path, players = futures[future]
+            try:
+                stats = future.result()
+            except Exception as e:
+                print("Could not analyse %s: %s" % (path, repr(e)))
+                failed += 1
+                continue
+            with db.transaction():
+                db.add_replay_stats(game_id, players.split(","), stats)
+            done += 1
+    db.commit()
+    print("Analysed %d replays, %d failed" % (done, failed))
+    return done
+
+
+class BotStager:
+    """ Snapshots bots into content-addressed directories under directory, so that every match
+    in a run launches exactly the same code however the source directories change meanwhile.
+    Only the bot's own files are staged (see bot_files and bot_file_set); an interpreter named
+    on the command line is left where it is.  Python files are byte-compiled once when staged. """
+    def __init__(self, directory="staging", precompile=True):
+        self.directory = os.path.abspath(directory)
+        self.precompile = precompile
+        self.staged = {}
+
+    def stage(self, command):
+        """ The command, rewritten to run from the staged copy """
+        if command not in self.staged:
+            posix = os.name != 'nt'
+            tokens = shlex.split(command, posix=posix)
+            own = bot_files(tokens)
+            if own:
+                tokens = [self.stage_file(token) if token in own else token for token in tokens]
+                staged = shlex.join(tokens) if posix else list2cmdline(tokens)
+                print("Staged %s as %s" % (command, staged))
+            else:
+                staged = command
+            self.staged[command] = staged
+        return self.staged[command]
+
+    def stage_file(self, path):
+        source, files = bot_file_set(path)
+        target = os.path.join(self.directory, content_digest(source, files).hexdigest()[:20])
+        if not os.path.isdir(target):
+            partial = target + ".partial-%d" % os.getpid()
+            for name in files:
+                os.makedirs(os.path.dirname(os.path.join(partial, name)), exist_ok=True)
+                shutil.copy2(os.path.join(source, name), os.path.join(partial, name))
+            if self.precompile and any(name.endswith(".py") for name in files):
+                import compileall
+                compileall.compile_dir(partial, quiet=1)
+            try:
+                os.rename(partial, target)
+            except OSError:     # someone else staged the same content first
+                shutil.rmtree(partial, ignore_errors=True)
+        return os.path.join(target, os.path.basename(path))
+
+
+class CpuAllocator:
+    """ Hands out disjoint sets of CPUs, one per running match: the engine plus one core per bot.
+    A match that needs more cores than are free waits until enough are released, so matches are
+    packed onto the cores by player count.  Contiguous runs of CPU numbers are preferred, which
+    usually keeps a match on neighbouring cores. """
+    def __init__(self, cpus=None):
+        self.cpus = sorted(os.sched_getaffinity(0) if cpus is None else cpus)
+        self.free = set(self.cpus)
+        self.taskset = shutil.which("taskset")
+
+    @staticmethod
+    def available():
+        return hasattr(os, "sched_setaffinity")
+
+    def acquire(self, num_players):
+        """ A set of free CPUs for a match of num_players, or None if there are not enough yet.
+        A match bigger than the whole machine gets every CPU, once they are all free. """
+        wanted = min(num_players + 1, len(self.cpus))
+        if len(self.free) < wanted:
+            return None
+        free = sorted(self.free)
+        chosen = free[:wanted]
+        for start in range(len(free) - wanted + 1):
+            if free[start + wanted - 1] - free[start] == wanted - 1:
+                chosen = free[start:start + wanted]
+                break
+        self.free.difference_update(chosen)
+        return set(chosen)
+
+    def release(self, cpus):
+        self.free.update(cpus)
+
+
+class MatchDurations:
+    """ Wall times of recent matches that finished normally, by map size and lineup and by map
+    size and number of players.  The deadline for a match is a high quantile of the most
+    specific history with at least min_samples entries, times margin; with too little history
+    there is no deadline, and the caller keeps its own. """
+    floor = 10.0
+
+    def __init__(self, quantile=99, margin=2.0, min_samples=20, history=200):
+        self.quantile = quantile
+        self.margin = margin
+        self.min_samples = min_samples
+        self.history = history
+        self.by_lineup = {}
+        self.by_shape = {}
+
+    def load(self, db):
+        for width, height, names, wall_time in db.match_durations():
+            self.add(width, height, names, wall_time)
+
+    def add(self, width, height, names, wall_time):
+        for table, key in ((self.by_lineup, (width, height) + tuple(sorted(names))), (self.by_shape, (width, height, len(names)))):
+            table.setdefault(key, collections.deque(maxlen=self.history)).append(wall_time)
+
+    def deadline(self, width, height, names):
+        for table, key in ((self.by_lineup, (width, height) + tuple(sorted(names))), (self.by_shape, (width, height, len(names)))):
+            times = table.get(key)
+            if times and len(times) >= self.min_samples:
+                return max(self.floor, self.margin * percentile(sorted(times), self.quantile))
+        return None
+
+
 class Manager:
-    def __init__(self, halite_binary, db_filename, players=None, rounds=-1):
+    def __init__(self, halite_binary, db_filename, players=None, rounds=-1, read_only=False):
         self.halite_binary = halite_binary
         self.players = players
         self.players_min = 2
         self.rounds = rounds
         self.round_count = 0
+        self.jobs = 1
         self.keep_replays = True
-        self.priority_sigma = True
+        self.replay_store = ReplayStore(replay_dir)
+        self.scheduler = SigmaScheduler()
+        self.rating_engine = FastRatingEngine()
         self.exclude_inactive = False
-        self.db = Database(db_filename)
-
-    def run_round(self, contestants, width, height, seed):
-        m = Match(contestants, width, height, seed, 2 * len(contestants) * max_match_rounds(width, height), self.keep_replays)
-        print(m)
-        m.run_match(self.halite_binary)
+        self.leaderboard = None
+        self.corpus = None
+        self.corpus_position = 0
+        self.cache_results = False
+        self.fingerprints = {}
+        self.coordinator = None
+        self.stager = None
+        self.cpu_allocator = None
+        self.durations = None
+        self.timings = None
+        self.resumed = collections.deque()
+        self.busy = collections.Counter()      # names of the bots in planned or running matches
+        self.db = Database(db_filename, read_only)
+
+    def new_match(self, contestants, width, height, seed):
+        m = Match(contestants, width, height, seed, self.time_limit(contestants, width, height), self.replay_store if self.keep_replays else None)
+        if self.stager:
+            m.paths = [self.stager.stage(path) for path in m.paths]
+        return m
+
+    def time_limit(self, contestants, width, height):
+        """ Seconds a match may take: learned from earlier matches like it when there are
+        enough of them (see MatchDurations), and never more than the fixed allowance """
+        limit = 2 * len(contestants) * max_match_rounds(width, height)
+        if self.durations:
+            learned = self.durations.deadline(width, height, [p.name for p in contestants])
+            if learned is not None:
+                return min(limit, learned)
+        return limit
+
+    def release_players(self, m):
+        """ The match's bots are no longer busy (see pick_contestants) """
+        self.busy -= collections.Counter(p.name for p in m.players)
+
+    def reserve_cpus(self, m):
+        """ Give m its own CPUs when pinning is on.  False if it has to wait for some to free up. """
+        if self.cpu_allocator is None or m.cached:
+            return True
+        m.cpus = self.cpu_allocator.acquire(m.num_players)
+        m.taskset = self.cpu_allocator.taskset
+        return m.cpus is not None
+
+    def release_cpus(self, m):
+        if m.cpus:
+            self.cpu_allocator.release(m.cpus)
+            m.cpus = None
+
+    def finish_round(self, m):
+        """ Apply the results of a completed match; only ever called from the coordinating thread """
+        self.release_players(m)
         print(m)
-        self.save_players(contestants)
-        self.db.update_player_ranks()
-        self.db.add_match(m)
-        self.show_ranks()
+        self.record_timing("halite", m.wall_time)
+        self.record_timing("replay", m.replay_time)
+        self.db.complete_queued(m)
+        if m.status == "timeout":
+            with self.stage("db"):
+                with self.db.transaction():
+                    self.db.apply_queued(m, self.db.add_match(m))
+            return
+        if self.durations and m.status == "ok" and not m.cached:
+            self.durations.add(m.width, m.height, [p.name for p in m.players], m.wall_time)
+        with self.stage("rate"):
+            update_skills(m.players, copy.deepcopy(m.results), self.rating_engine)
+            for player in m.players:
+                self.players.touch(player)
+            self.scheduler.rated(m.players)
+        with self.stage("db"):
+            with self.db.transaction():
+                self.save_players(m.players)
+                self.db.update_player_ranks()
+                game_id = self.db.add_match(m)
+                if m.cache_key and not m.cached:
+                    self.db.cache_result(m.cache_key, m, game_id)
+                self.db.apply_queued(m, game_id)
+        with self.stage("ranks"):
+            if self.leaderboard:
+                self.leaderboard.update(m.players)
+            else:
+                self.show_ranks()
+
+    def resume_queue(self):
+        """ Pick up the match queue where an earlier run left off: results that came in but were
+        never applied are applied now, in the order they were planned, and matches that were
+        planned or still running are played before any new ones are planned """
+        for queue_id, state, width, height, seed, names, outcome in self.db.unapplied_matches():
+            if not all(name in self.players.by_name for name in names):
+                print("Dropping queued match %d: not all of %s are active any more" % (queue_id, ", ".join(names)))
+                self.db.drop_queued(queue_id)
+                continue
+            m = self.new_match([self.players[name] for name in names], width, height, seed)
+            m.queue_id = queue_id
+            if state == "completed":
+                print("Applying the result of queued match %d" % queue_id)
+                m.restore(outcome)
+                self.finish_round(m)
+            else:
+                self.resumed.append(m)
+        if self.resumed:
+            print("Resuming %d queued matches" % len(self.resumed))
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Time the block under name when self.timings is collecting (see run_benchmark) """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_timing(name, time.perf_counter() - start)
+
+    def record_timing(self, name, seconds):
+        if self.timings is not None and seconds is not None:
+            self.timings.setdefault(name, []).append(seconds)
 
     def save_players(self, players):
         for player in players:
@@ -155,18 +1154,7 @@ class Manager:
             self.db.save_player(player)
 
     def pick_contestants(self, num):
-        pool = list(self.players)   #this makes a copy
-        contestants = list()
-        if self.priority_sigma:
-            high_sigma_index = max((player.sigma, i) for i, player in enumerate(self.players))[1]
-            high_sigma_contestant = self.players[high_sigma_index]
-            contestants.append(high_sigma_contestant)
-            pool.remove(high_sigma_contestant)
-            num -= 1
-        random.shuffle(pool)
-        contestants.extend(pool[:num])
-        random.shuffle(contestants)
-        return contestants
+        return self.scheduler.pick(self.players, num, busy=self.busy)
 
 
     def run_rounds(self, player_dist, map_dist):
@@ -178,24 +1166,320 @@ class Manager:
     def run_rounds_unix(self, player_dist, map_dist):
         from keyboard_detection import keyboard_detection
         with keyboard_detection() as key_pressed:
-            while not key_pressed() and ((self.rounds < 0) or (self.round_count < self.rounds)):
-                self.setup_round(player_dist, map_dist)
+            self.run_rounds_until(key_pressed, player_dist, map_dist)
 
     def run_rounds_windows(self, player_dist, map_dist):
         import msvcrt
-        while not  msvcrt.kbhit()and ((self.rounds < 0) or (self.round_count < self.rounds)):
+        self.run_rounds_until(msvcrt.kbhit, player_dist, map_dist)
+
+    def run_rounds_async(self, player_dist, map_dist):
+        if self.coordinator:
+            # the workers play the matches, so there is nothing to overlap here
+            self.run_rounds(player_dist, map_dist)
+            return
+        import asyncio
+        try:
+            from keyboard_detection import keyboard_detection
+        except ImportError:
+            import msvcrt
+            asyncio.run(self.run_rounds_coroutine(player_dist, map_dist, msvcrt.kbhit))
+            return
+        with keyboard_detection():
+            asyncio.run(self.run_rounds_coroutine(player_dist, map_dist))
+
+    async def run_rounds_coroutine(self, player_dist, map_dist, key_pressed=None):
+        """ Overlap up to self.jobs matches on one event loop.  The stop key is noticed as soon
+        as it is pressed; no new matches are started after that, and the ones already running
+        are allowed to finish and are recorded as usual. """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        if key_pressed is None:
+            fd = sys.stdin.fileno()
+            def on_key():
+                loop.remove_reader(fd)
+                stop.set()
+            loop.add_reader(fd, on_key)
+        else:
+            async def poll_keyboard():
+                while not key_pressed():
+                    await asyncio.sleep(0.2)
+                stop.set()
+            poller = asyncio.ensure_future(poll_keyboard())
+        scheduled = self.round_count
+        in_flight = {}
+        waiting = None
+        stop_wait = asyncio.ensure_future(stop.wait())
+        try:
+            while True:
+                while not stop.is_set() and len(in_flight) < self.jobs and self.rounds_remaining(scheduled):
+                    m = waiting or self.plan_round(player_dist, map_dist)
+                    waiting = None
+                    if not self.reserve_cpus(m):
+                        waiting = m
+                        break
+                    print ("\n------------------- starting new match... -------------------\n")
+                    print(m)
+                    in_flight[asyncio.ensure_future(m.run_match_async(self.halite_binary))] = m
+                    scheduled += 1
+                if not in_flight:
+                    break
+                done, _ = await asyncio.wait(list(in_flight) + [stop_wait], return_when=asyncio.FIRST_COMPLETED)
+                if stop_wait in done:
+                    print("Stop requested, waiting for %d running matches to finish" % len(in_flight))
+                    stop_wait = asyncio.ensure_future(asyncio.Event().wait())
+                for task in done:
+                    m = in_flight.pop(task, None)
+                    if m is None:
+                        continue
+                    self.release_cpus(m)
+                    try:
+                        task.result()
+                    except Exception as e:
+                        print("Match failed: %s" % repr(e))
+                        self.release_players(m)
+                        continue
+                    self.finish_round(m)
+                    self.round_count += 1
+        finally:
+            stop_wait.cancel()
+            if key_pressed is None:
+                loop.remove_reader(fd)
+            else:
+                poller.cancel()
+
+    def rounds_remaining(self, scheduled):
+        return (self.rounds < 0) or (scheduled < self.rounds)
+
+    def run_rounds_until(self, stop_requested, player_dist, map_dist):
+        if self.coordinator:
+            self.run_rounds_remote(stop_requested, player_dist, map_dist)
+            return
+        if self.jobs > 1:
+            self.run_rounds_parallel(stop_requested, player_dist, map_dist)
+            return
+        while not stop_requested() and self.rounds_remaining(self.round_count):
             self.setup_round(player_dist, map_dist)
 
+    def run_rounds_parallel(self, stop_requested, player_dist, map_dist):
+        """ Keep up to self.jobs matches running at once.  Only the halite subprocesses run in
+        the worker threads: contestant picking, rating updates and database writes all happen
+        here, one match at a time, so the ratings stay consistent. """
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        scheduled = self.round_count
+        in_flight = {}
+        waiting = None      # planned, but held back until enough CPUs are free
+        stopping = False
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while True:
+                if not stopping and stop_requested():
+                    print("Stop requested, waiting for %d running matches to finish" % len(in_flight))
+                    stopping = True
+                while not stopping and len(in_flight) < self.jobs and self.rounds_remaining(scheduled):
+                    m = waiting or self.plan_round(player_dist, map_dist)
+                    waiting = None
+                    if not self.reserve_cpus(m):
+                        waiting = m
+                        break
+                    print ("\n------------------- starting new match... -------------------\n")
+                    print(m)
+                    in_flight[pool.submit(m.run_match, self.halite_binary)] = m
+                    scheduled += 1
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    m = in_flight.pop(future)
+                    self.release_cpus(m)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print("Match failed: %s" % e)
+                        self.release_players(m)
+                        continue
+                    self.finish_round(m)
+                    self.round_count += 1
+
+    def run_rounds_remote(self, stop_requested, player_dist, map_dist):
+        """ Like run_rounds_parallel, but the matches are played by workers (see run_worker).
+        Results are still applied here, one at a time. """
+        dispatcher = self.coordinator.dispatcher
+        scheduled = self.round_count
+        stopping = False
+        while True:
+            if not stopping and stop_requested():
+                cancelled = dispatcher.cancel_pending()
+                print("Stop requested, %d queued matches cancelled, waiting for %d leased matches to finish" % (cancelled, dispatcher.in_flight()))
+                stopping = True
+            while not stopping and dispatcher.in_flight() < self.jobs and self.rounds_remaining(scheduled):
+                m = self.plan_round(player_dist, map_dist)
+                scheduled += 1
+                if m.cached:
+                    self.finish_round(m)
+                    self.round_count += 1
+                else:
+                    dispatcher.submit(m)
+            dispatcher.requeue_expired()
+            while not dispatcher.dropped.empty():
+                m = dispatcher.dropped.get()
+                self.release_players(m)
+                self.db.drop_queued(m.queue_id)
+            if not dispatcher.in_flight() and dispatcher.completed.empty():
+                break
+            try:
+                m = dispatcher.completed.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if m.status != "timeout":
+                m.store_replay()
+            self.finish_round(m)
+            self.round_count += 1
+
+    def plan_round(self, player_dist, map_dist):
+        if self.resumed:
+            m = self.resumed.popleft()
+        else:
+            num_contestants = random.choice(player_dist)
+            with self.stage("pick"):
+                contestants = self.pick_contestants(num_contestants)
+            size_w, size_h, seed = self.next_map(map_dist)
+            m = self.new_match(contestants, size_w, size_h, seed)
+            self.db.queue_match(m)
+        self.busy.update(p.name for p in m.players)
+        if self.cache_results:
+            self.find_cached_result(m)
+        return m
+
+    def next_map(self, map_dist):
+        """ Width, height and seed of the next map: from the corpus if there is one, random otherwise """
+        if self.corpus:
+            size_w, size_h, seed = self.corpus[self.corpus_position % len(self.corpus)]
+            self.corpus_position += 1
+            return size_w, size_h, seed
+        size_w, size_h = self.pick_map(map_dist)
+        return size_w, size_h, random.randint(10000, 2073741824)
+
+    def pick_map(self, map_dist, rng=random):
+        if map_dist:
+            size = rng.choice(map_dist)
+            return size, size
+        size_w = rng.choice(default_map_widths)
+        return size_w, int((size_w * 2) / 3)
+
+    def load_corpus(self, count, corpus_seed, map_dist):
+        """ A fixed list of count (width, height, seed) maps; the same corpus_seed always gives the same maps """
+        rng = random.Random(corpus_seed)
+        self.corpus = [self.pick_map(map_dist, rng) + (rng.randint(10000, 2073741824),) for _ in range(count)]
+        self.corpus_position = 0
+
+    def fingerprint(self, command):
+        if command not in self.fingerprints:
+            self.fingerprints[command] = bot_fingerprint(command)
+        return self.fingerprints[command]
+
+    def find_cached_result(self, m):
+        """ Look the match up in the result cache: same engine, same bots (by content) in the same
+        seats, same map.  A hit fills in the results and the match won't be played. """
+        key = [self.fingerprint(self.halite_binary), [self.fingerprint(path) for path in m.paths], m.width, m.height, m.map_seed]
+        m.cache_key = hashlib.sha256(json.dumps(key).encode()).hexdigest()
+        found = self.db.find_cached_result(m.cache_key)
+        if found:
+            print("Using the cached result for this lineup and map")
+            m.results, m.replay_file = json.loads(found[0]), found[1]
+            m.cached = True
+
     def setup_round (self, player_dist, map_dist):
-        num_contestants = random.choice(player_dist)
-        contestants = self.pick_contestants(num_contestants)
-        size_w = random.choice([312, 264, 336, 240, 360, 384])
-        size_h = int((size_w * 2) / 3)
-        seed = random.randint(10000, 2073741824)
+        m = self.plan_round(player_dist, map_dist)
         print ("\n------------------- running new match... -------------------\n")
-        self.run_round(contestants, size_w, size_h, seed)
+        print(m)
+        self.reserve_cpus(m)
+        try:
+            m.run_match(self.halite_binary)
+        finally:
+            self.release_cpus(m)
+        self.finish_round(m)
         self.round_count += 1
 
+    def run_head_to_head(self, name_a, name_b, test, max_games, map_dist):
+        try:
+            from keyboard_detection import keyboard_detection
+        except ImportError:
+            import msvcrt
+            return self.run_head_to_head_until(msvcrt.kbhit, name_a, name_b, test, max_games, map_dist)
+        with keyboard_detection() as key_pressed:
+            return self.run_head_to_head_until(key_pressed, name_a, name_b, test, max_games, map_dist)
+
+    def run_head_to_head_until(self, stop_requested, name_a, name_b, test, max_games, map_dist, max_timeouts=3):
+        """ Play pairs of games between a and b until the test is decided, max_games have been
+        played (timed out ones included), max_timeouts pairs in a row have had a match time out,
+        or stop_requested() is true.  Every game is rated and recorded like any other. """
+        a, b = self.players[name_a], self.players[name_b]
+        verdict = None
+        played = 0
+        timeouts = 0
+        while verdict is None and played + 2 <= max_games and not stop_requested():
+            width, height, seed = self.next_map(map_dist)
+            pair = [self.new_match([a, b], width, height, seed), self.new_match([b, a], width, height, seed)]
+            if self.cache_results:
+                for m in pair:
+                    self.find_cached_result(m)
+            print ("\n------------------- running new pair of matches... -------------------\n")
+            self.play_pair(pair)
+            score = 0.0
+            for m in pair:
+                self.finish_round(m)
+                self.round_count += 1
+            played += 2
+            if any(m.status == "timeout" for m in pair):
+                timeouts += 1
+                print("Not counting a pair with a timed out match")
+                if timeouts >= max_timeouts:
+                    print("Giving up: %d pairs in a row had a match time out" % timeouts)
+                    break
+                continue
+            timeouts = 0
+            for m in pair:
+                rank_a, rank_b = m.results[m.players.index(a)], m.results[m.players.index(b)]
+                score += 1.0 if rank_a < rank_b else 0.5 if rank_a == rank_b else 0.0
+            test.add(score / 2.0)
+            verdict = test.result()
+            print("SPRT %s vs %s: %d games, LLR %.2f (bounds %.2f, %.2f)" % (a.name, b.name, 2 * test.pairs(), test.llr(), test.lower, test.upper))
+        self.show_head_to_head(a, b, test, verdict)
+        return verdict
+
+    def play_pair(self, pair):
+        """ Both games of a pair at once when jobs (and free CPUs) allow, one after the other otherwise """
+        from concurrent.futures import ThreadPoolExecutor
+        try:
+            if self.jobs > 1 and all(self.reserve_cpus(m) for m in pair):
+                with ThreadPoolExecutor(max_workers=len(pair)) as pool:
+                    for future in [pool.submit(m.run_match, self.halite_binary) for m in pair]:
+                        future.result()
+            else:
+                for m in pair:
+                    self.release_cpus(m)
+                for m in pair:
+                    self.reserve_cpus(m)
+                    m.run_match(self.halite_binary)
+                    self.release_cpus(m)
+        finally:
+            for m in pair:
+                self.release_cpus(m)
+
+    def show_head_to_head(self, a, b, test, verdict):
+        elo, low, high = test.elo()
+        mu_margin = 1.96 * math.sqrt(a.sigma ** 2 + b.sigma ** 2)
+        print()
+        print("%s vs %s: %d games in %d pairs" % (a.name, b.name, 2 * test.pairs(), test.pairs()))
+        print("Elo difference %+.1f (95%% confidence %+.1f to %+.1f)" % (elo, low, high))
+        print("TrueSkill mu difference %+.2f (95%% confidence %+.2f to %+.2f)" % (a.mu - b.mu, a.mu - b.mu - mu_margin, a.mu - b.mu + mu_margin))
+        if verdict == "H1":
+            print("H1 accepted: %s is stronger than %s by %g Elo or more" % (a.name, b.name, test.elo1))
+        elif verdict == "H0":
+            print("H0 accepted: %s is not shown to be stronger than %s by %g Elo (elo1); the difference is %+.1f Elo (95%% confidence %+.1f to %+.1f)" % (a.name, b.name, test.elo1, elo, low, high))
+        else:
+            print("Inconclusive: stopped before the test was decided (LLR %.2f)" % test.llr())
+
     def add_player(self, name, path):
         p = self.db.get_player((name,))
         if len(p) == 0:
@@ -225,14 +1509,79 @@ class Manager:
         for p in self.db.retrieve(sql):
             print(str(parse_player_record(p)))
 
+    def show_performance(self, names=None):
+        print()
+        print("{:<25}{:>6}{:>7}   {:^26}   {:^26}   {:^26}".format("name", "games", "errors", "wall time p50/p95/p99 (s)", "cpu time p50/p95/p99 (s)", "peak rss p50/p95/p99 (MB)"))
+        for name, (games, errors, walls, cpus, rsses) in sorted(self.db.bot_performance(names).items()):
+            wall = "/".join("%.2f" % percentile(walls, q) for q in (50, 95, 99))
+            cpu = "/".join("%.2f" % percentile(cpus, q) for q in (50, 95, 99))
+            rss = "/".join("%.1f" % (percentile(rsses, q) / 1048576.0) for q in (50, 95, 99))
+            print("{:<25}{:>6}{:>7}   {:^26}   {:^26}   {:^26}".format(name, games, errors, wall, cpu, rss))
+
+    def show_replay_summary(self, names=None):
+        print()
+        print("{:<25}{:>6}{:>12}{:>14}{:>16}{:>17}{:>16}".format("name", "games", "eliminated", "median turn", "peak territory", "final territory", "final strength"))
+        for name, (games, eliminated, peaks, territories, strengths) in sorted(self.db.replay_summary(names).items()):
+            turn = "%d" % percentile(sorted(eliminated), 50) if eliminated else "-"
+            print("{:<25}{:>6}{:>11.0f}%{:>14}{:>16.0f}{:>17.0f}{:>16.0f}".format(name, games, 100.0 * len(eliminated) / games, turn, sum(peaks) / games, sum(territories) / games, sum(strengths) / games))
+
+    def show_stats(self, names=None, form_games=10):
+        """ Per bot: win rate, average finish and recent form, all from the aggregate tables.
+        Named bots also get their head-to-head record and finishes by map size. """
+        print()
+        print("{:<25}{:>7}{:>7}{:>12}{:>12}   {}".format("name", "games", "wins", "avg finish", "skill trend", "last %d finishes" % form_games))
+        summary = self.db.bot_summary(names)
+        for name, (games, wins, finish_sum) in sorted(summary.items(), key=lambda item: item[1][2] / item[1][0]):
+            history = self.db.rating_history(name, form_games + 1)
+            trend = "%+.2f" % (history[-1][5] - history[0][5]) if len(history) > 1 else "-"
+            form = " ".join("%d/%d" % (finish, field_size) for _, field_size, finish, _, _, _ in history[-form_games:])
+            print("{:<25}{:>7}{:>6.0f}%{:>11.0f}%{:>12}   {}".format(name, games, 100.0 * wins / games, 100.0 * finish_sum / games, trend, form))
+        for name in names or ():
+            if name not in summary:
+                print("\nNo games for %s" % name)
+                continue
+            print("\n%s head to head" % name)
+            print("{:<25}{:>7}{:>7}{:>8}{:>7}{:>8}".format("opponent", "games", "wins", "losses", "draws", "win %"))
+            for opponent, games, wins, losses, draws in self.db.pairwise_stats(name):
+                print("{:<25}{:>7}{:>7}{:>8}{:>7}{:>7.0f}%".format(opponent, games, wins, losses, draws, 100.0 * (wins + draws / 2.0) / games))
+            print("\n%s by map size" % name)
+            print("{:<10}{:>7}{:>7}{:>12}   {}".format("map", "games", "wins", "avg finish", "finishes (place/players: games)"))
+            for (width, height), counts in sorted(self.db.finish_distribution(name).items(), key=lambda item: (item[0][0], item[0][1] or 0)):
+                games = sum(counts.values())
+                wins = sum(count for (_, finish), count in counts.items() if finish == 1)
+                finish_sum = sum(count * (finish - 1.0) / (field_size - 1) for (field_size, finish), count in counts.items())
+                spread = " ".join("%d/%d: %d" % (finish, field_size, count) for (field_size, finish), count in sorted(counts.items()))
+                print("{:<10}{:>7}{:>6.0f}%{:>11.0f}%   {}".format("%sx%s" % (width, height or "?"), games, 100.0 * wins / games, 100.0 * finish_sum / games, spread))
+
             
 class Database:
-    def __init__(self, filename):
+    def __init__(self, filename, read_only=False):
+        self.transaction_depth = 0
+        self.group_commit = 1
+        self.pending_transactions = 0
+        if read_only:
+            self.connect_read_only(filename)
+        else:
+            self.connect(filename)
+            self.recreate()
+
+    def connect(self, filename):
         self.db = sqlite3.connect(filename)
-        self.recreate()
+        self.db.execute("pragma journal_mode=wal")
+        self.db.execute("pragma synchronous=normal")
+
+    def connect_read_only(self, filename):
+        """ Open an existing, up to date database read-only, without running the migrations.
+        Raises sqlite3.Error if the file is missing or its schema is out of date. """
+        path = urllib.parse.quote(os.path.abspath(filename).replace(os.sep, "/"), safe="/:")
+        self.db = sqlite3.connect("file:%s?mode=ro" % path, uri=True)
+        if self.retrieve("pragma user_version")[0][0] != len(self.schema_steps):
+            self.db.close()
+            raise sqlite3.OperationalError("the database schema needs upgrading")
 
     def __del__(self):
         try:
+            self.commit()
             self.db.close()
         except: pass
 
@@ -240,13 +1589,90 @@ class Database:
         return datetime.datetime.now().strftime("%d.%m.%Y %H:%M:%S")
 
     def recreate(self):
-        cursor = self.db.cursor()
+        self.migrate()
+
+    def migrate(self):
+        """ Bring the schema up to date.  The version is kept in pragma user_version, and each
+        step in schema_steps upgrades it by one, so older database files are upgraded in place. """
+        version = self.retrieve("pragma user_version")[0][0]
+        for number, step in enumerate(self.schema_steps[version:], version + 1):
+            with self.transaction():
+                step(self, self.db.cursor())
+                self.update_deferred("pragma user_version = %d" % number)
+            self.commit()
+
+    def schema_v1(self, cursor):
+        cursor.execute("create table if not exists games(id integer primary key, game_id integer, name text, finish integer, field_size integer, map_size integer, map_seed integer, timestamp date, replay_file text)")
+        cursor.execute("create table if not exists players(id integer primary key, name text unique, path text, lastseen date, rank integer default 1000, skill real default 0.0, mu real default 25.0, sigma real default 8.33,ngames integer default 0, active integer default 1)")
+
+    def schema_v2(self, cursor):
+        cursor.execute("create table if not exists matches(id integer primary key, field_size integer, width integer, height integer, map_seed integer, timestamp date, replay_file text)")
+        cursor.execute("insert into matches (id, field_size, width, map_seed, timestamp, replay_file) select game_id, field_size, map_size, map_seed, timestamp, replay_file from games where game_id is not null group by game_id")
+        cursor.execute("create index if not exists games_game_id on games(game_id)")
+        cursor.execute("create index if not exists games_name on games(name, game_id)")
+        cursor.execute("create index if not exists games_timestamp on games(timestamp)")
+
+    def schema_v3(self, cursor):
+        cursor.execute("create table if not exists replays(game_id integer primary key, map_seed integer, players text, size integer, stored_size integer, path text, created real)")
+        cursor.execute("create index if not exists replays_created on replays(created)")
+
+    def schema_v4(self, cursor):
+        cursor.execute("create table if not exists match_stats(game_id integer primary key, wall_time real, cpu_time real, peak_rss integer, status text, return_code integer)")
+        cursor.execute("create table if not exists bot_stats(id integer primary key, game_id integer, name text, wall_time real, cpu_time real, peak_rss integer, status text)")
+        cursor.execute("create index if not exists bot_stats_name on bot_stats(name, game_id)")
+
+    def schema_v5(self, cursor):
+        cursor.execute("create table if not exists result_cache(key text primary key, results text, replay_file text, game_id integer, created real)")
+
+    def schema_v6(self, cursor):
+        # the curves are native int arrays (array typecode "i"), one value per frame
+        cursor.execute("create table if not exists replay_stats(game_id integer, seat integer, name text, frames integer, eliminated integer, peak_territory integer, final_territory integer, final_strength integer, final_production integer, territory blob, strength blob, production blob, primary key (game_id, seat))")
+        cursor.execute("create index if not exists replay_stats_name on replay_stats(name, game_id)")
+
+    def schema_v7(self, cursor):
+        # state goes planned -> completed -> applied (or dropped); outcome is Match.outcome() as json
+        cursor.execute("create table if not exists match_queue(id integer primary key, state text, width integer, height integer, map_seed integer, players text, outcome text, game_id integer, created real, updated real)")
+        cursor.execute("create index if not exists match_queue_state on match_queue(state, id)")
+
+    def schema_v8(self, cursor):
+        # aggregates kept up to date by add_match_aggregates; rating_history only holds the last rating_history_length games per bot
+        cursor.execute("create table if not exists pair_stats(name text, opponent text, games integer, wins integer, losses integer, draws integer, primary key (name, opponent))")
+        cursor.execute("create table if not exists finish_stats(name text, width integer, height integer, field_size integer, finish integer, games integer, primary key (name, width, height, field_size, finish))")
+        cursor.execute("create table if not exists rating_history(id integer primary key, name text, game_id integer, field_size integer, finish integer, mu real, sigma real, skill real)")
+        cursor.execute("create index if not exists rating_history_name on rating_history(name, id)")
+        self.rebuild_match_aggregates()
+
+    schema_steps = [schema_v1, schema_v2, schema_v3, schema_v4, schema_v5, schema_v6, schema_v7, schema_v8]
+
+    rating_history_length = 100
+
+    @contextlib.contextmanager
+    def transaction(self, counted=True):
+        """ Make all the writes inside the block atomic, with a single commit at the end.
+        With group_commit > 1 the commit is held back until that many transactions have
+        completed; commit() flushes whatever is pending.  An uncounted transaction (the match
+        queue's bookkeeping) doesn't count towards group_commit: with group_commit > 1 it
+        goes out with the next commit. """
+        if not self.transaction_depth and not self.db.in_transaction:
+            self.db.execute("begin")
+        self.transaction_depth += 1
+        self.db.execute("savepoint write_batch")
         try:
-            cursor.execute("create table games(id integer primary key, game_id integer, name text, finish integer, field_size integer, map_size integer, map_seed integer, timestamp date, replay_file text)")
-            cursor.execute("create table players(id integer primary key, name text unique, path text, lastseen date, rank integer default 1000, skill real default 0.0, mu real default 25.0, sigma real default 8.33,ngames integer default 0, active integer default 1)")
-            self.db.commit()
+            yield
         except:
-            pass
+            self.db.execute("rollback to write_batch")
+            raise
+        finally:
+            self.db.execute("release write_batch")
+            self.transaction_depth -= 1
+        if not self.transaction_depth:
+            self.pending_transactions += counted
+            if self.pending_transactions >= self.group_commit or (not counted and self.group_commit == 1):
+                self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.pending_transactions = 0
 
     def update_deferred( self, sql, tup=() ):
         cursor = self.db.cursor()        
@@ -254,12 +1680,14 @@ class Database:
         
     def update( self, sql, tup=() ):
         self.update_deferred(sql,tup)
-        self.db.commit()
+        if not self.transaction_depth:
+            self.commit()
 
     def update_many(self, sql, iterable):
         cursor = self.db.cursor()
         cursor.executemany(sql, iterable)
-        self.db.commit()
+        if not self.transaction_depth:
+            self.commit()
         
     def retrieve( self, sql, tup=() ):
         cursor = self.db.cursor()        
@@ -267,10 +1695,185 @@ class Database:
         return cursor.fetchall()
 
     def add_match( self, match ):
-        sql = 'SELECT max(game_id) FROM games'
-        game_id = self.retrieve(sql)[0][0]
-        game_id = int(game_id) + 1 if game_id else 1
-        self.update_many("INSERT INTO games (game_id, name, finish, field_size, map_size, map_seed, timestamp, replay_file) VALUES (?,?,?,?,?,?,?,?)", [(game_id, player.name, rank, match.num_players, match.width, match.map_seed, self.now(), match.replay_file) for player, rank in zip(match.players, match.results)])
+        timestamp = self.now()
+        cursor = self.db.cursor()
+        cursor.execute("INSERT INTO matches (field_size, width, height, map_seed, timestamp, replay_file) VALUES (?,?,?,?,?,?)", (match.num_players, match.width, match.height, match.map_seed, timestamp, match.replay_file))
+        game_id = cursor.lastrowid
+        if match.stored_size is not None:
+            self.update_deferred("INSERT INTO replays (game_id, map_seed, players, size, stored_size, path, created) VALUES (?,?,?,?,?,?,?)", (game_id, match.map_seed, ",".join(p.name for p in match.players), match.replay_size, match.stored_size, match.replay_file, time.time()))
+        if match.wall_time is not None:
+            self.add_match_stats(game_id, match)
+        if match.status == "timeout":
+            return game_id      # no result to record
+        self.update_many("INSERT INTO games (game_id, name, finish, field_size, map_size, map_seed, timestamp, replay_file) VALUES (?,?,?,?,?,?,?,?)", [(game_id, player.name, rank, match.num_players, match.width, match.map_seed, timestamp, match.replay_file) for player, rank in zip(match.players, match.results)])
+        self.add_match_aggregates(game_id, match)
+        return game_id
+
+    def add_match_aggregates(self, game_id, match):
+        """ Fold one match into pair_stats, finish_stats and rating_history (with the players' ratings after the match) """
+        seats = [(player.name, rank) for player, rank in zip(match.players, match.results)]
+        cursor = self.db.cursor()
+        cursor.executemany("INSERT INTO pair_stats VALUES (?,?,1,?,?,?) ON CONFLICT (name, opponent) DO UPDATE SET games=games+1, wins=wins+excluded.wins, losses=losses+excluded.losses, draws=draws+excluded.draws",
+                           [(name, opponent, rank < other, rank > other, rank == other) for name, rank in seats for opponent, other in seats if opponent != name])
+        cursor.executemany("INSERT INTO finish_stats VALUES (?,?,?,?,?,1) ON CONFLICT (name, width, height, field_size, finish) DO UPDATE SET games=games+1",
+                           [(name, match.width, match.height, match.num_players, rank) for name, rank in seats])
+        cursor.executemany("INSERT INTO rating_history (name, game_id, field_size, finish, mu, sigma, skill) VALUES (?,?,?,?,?,?,?)",
+                           [(player.name, game_id, match.num_players, rank, player.mu, player.sigma, player.skill) for player, rank in zip(match.players, match.results)])
+        cursor.executemany("DELETE FROM rating_history WHERE name=? AND id <= (SELECT id FROM rating_history WHERE name=? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                           [(player.name, player.name, self.rating_history_length) for player in match.players])
+
+    def rebuild_match_aggregates(self):
+        """ Recompute pair_stats and finish_stats from the games table """
+        self.update_deferred("delete from pair_stats")
+        self.update_deferred("delete from finish_stats")
+        self.update_deferred("insert into pair_stats select a.name, b.name, count(*), sum(a.finish < b.finish), sum(a.finish > b.finish), sum(a.finish = b.finish) from games a join games b on b.game_id = a.game_id and b.name != a.name group by a.name, b.name")
+        self.update_deferred("insert into finish_stats select g.name, m.width, m.height, g.field_size, g.finish, count(*) from games g join matches m on m.id = g.game_id group by g.name, m.width, m.height, g.field_size, g.finish")
+
+    def replace_rating_history(self, history):
+        """ history is {name: [(game_id, field size, finish, mu, sigma)]}, oldest first """
+        self.update_deferred("delete from rating_history")
+        rows = sorted((game_id, name, field_size, finish, mu, sigma, mu - sigma * 3) for name, entries in history.items() for game_id, field_size, finish, mu, sigma in entries)
+        self.update_many("INSERT INTO rating_history (game_id, name, field_size, finish, mu, sigma, skill) VALUES (?,?,?,?,?,?,?)", rows)
+
+    def rebuild_stats(self, engine):
+        """ Recompute pair_stats, finish_stats and rating_history from scratch; the rating
+        history comes from replaying the games through engine, as rerate does.  Returns the
+        number of games. """
+        _, history, games = self.replay_ratings(engine)
+        with self.transaction():
+            self.rebuild_match_aggregates()
+            self.replace_rating_history(history)
+        self.commit()
+        return games
+
+    def add_match_stats(self, game_id, match):
+        self.update_deferred("INSERT INTO match_stats (game_id, wall_time, cpu_time, peak_rss, status, return_code) VALUES (?,?,?,?,?,?)", (game_id, match.wall_time, match.cpu_time, match.peak_rss, match.status, match.return_code))
+        cursor = self.db.cursor()
+        cursor.executemany("INSERT INTO bot_stats (game_id, name, wall_time, cpu_time, peak_rss, status) VALUES (?,?,?,?,?,?)", [(game_id, player.name, wall, cpu, rss, status) for player, (wall, cpu, rss, status) in zip(match.players, match.bot_usage)])
+
+    def match_durations(self, limit=100000):
+        """ (width, height, player names, wall time) of the most recent limit matches that
+        finished normally, oldest first """
+        rows = self.retrieve("select m.width, m.height, group_concat(g.name, char(9)), s.wall_time from match_stats s join matches m on m.id = s.game_id join games g on g.game_id = s.game_id where s.status = 'ok' group by s.game_id order by s.game_id desc limit ?", (limit,))
+        return [(width, height, names.split("\t"), wall_time) for width, height, names, wall_time in reversed(rows)]
+
+    def bot_performance(self, names=None):
+        """ {name: (games, errors, wall times, cpu times, peak rss)} with each list sorted """
+        sql = "select name, wall_time, cpu_time, peak_rss, status from bot_stats"
+        if names:
+            sql += " where name in (%s)" % ",".join("?" * len(names))
+        found = {}
+        for name, wall, cpu, rss, status in self.retrieve(sql, tuple(names or ())):
+            games, errors, walls, cpus, rsses = found.setdefault(name, [0, 0, [], [], []])
+            found[name][0] += 1
+            found[name][1] += status != "ok"
+            walls.append(wall)
+            cpus.append(cpu)
+            rsses.append(rss)
+        for entry in found.values():
+            for values in entry[2:]:
+                values.sort()
+        return found
+
+    def unanalyzed_replays(self, directory=replay_dir):
+        """ (game_id, path, comma separated players) of every replay with no replay_stats yet.
+        Besides the replays table, that covers matches recorded before it existed, whose
+        replays were moved into directory under the name halite gave them. """
+        found = self.retrieve("select game_id, path, players from replays where game_id not in (select game_id from replay_stats)")
+        older = self.retrieve("select m.id, m.replay_file, (select group_concat(name) from (select name from games g where g.game_id = m.id order by g.id)) from matches m where m.replay_file is not null and m.replay_file != '' and m.id not in (select game_id from replays) and m.id not in (select game_id from replay_stats) and m.replay_file not in (select path from replays)")
+        for game_id, replay_file, players in older:
+            for path in (replay_file, os.path.join(directory, os.path.basename(replay_file))):
+                if players and os.path.isfile(path):
+                    found.append((game_id, path, players))
+                    break
+        return sorted(found)
+
+    def add_replay_stats(self, game_id, names, stats):
+        rows = []
+        for seat, (name, player) in enumerate(zip(names, stats["players"])):
+            territory = player["territory"]
+            rows.append((game_id, seat, name, stats["frames"], player["eliminated"], max(territory, default=0),
+                         territory[-1] if territory else 0, player["strength"][-1] if territory else 0, player["production"][-1] if territory else 0,
+                         territory.tobytes(), player["strength"].tobytes(), player["production"].tobytes()))
+        self.update_many("insert or replace into replay_stats values (?,?,?,?,?,?,?,?,?,?,?,?)", rows)
+
+    def replay_summary(self, names=None):
+        """ {name: (games, eliminated turns, peak territories, final territories, final strengths)} """
+        sql = "select name, eliminated, peak_territory, final_territory, final_strength from replay_stats"
+        if names:
+            sql += " where name in (%s)" % ",".join("?" * len(names))
+        found = {}
+        for name, eliminated, peak, territory, strength in self.retrieve(sql, tuple(names or ())):
+            entry = found.setdefault(name, [0, [], [], [], []])
+            entry[0] += 1
+            if eliminated is not None:
+                entry[1].append(eliminated)
+            entry[2].append(peak)
+            entry[3].append(territory)
+            entry[4].append(strength)
+        return found
+
+    def bot_summary(self, names=None):
+        """ {name: (games, wins, finish sum)} from finish_stats; each finish counts 0 for
+        a win and 1 for finishing last, so the average is comparable across field sizes """
+        sql = "select name, sum(games), sum(case when finish = 1 then games else 0 end), sum(games * (finish - 1.0) / (field_size - 1)) from finish_stats"
+        if names:
+            sql += " where name in (%s)" % ",".join("?" * len(names))
+        return {name: (games, wins, finish_sum) for name, games, wins, finish_sum in self.retrieve(sql + " group by name", tuple(names or ()))}
+
+    def pairwise_stats(self, name):
+        """ [(opponent, games, wins, losses, draws)], most played first """
+        return self.retrieve("select opponent, games, wins, losses, draws from pair_stats where name=? order by games desc, opponent", (name,))
+
+    def finish_distribution(self, name):
+        """ {(width, height): {(field size, finish): games}} """
+        found = {}
+        for width, height, field_size, finish, games in self.retrieve("select width, height, field_size, finish, games from finish_stats where name=?", (name,)):
+            found.setdefault((width, height), {})[field_size, finish] = games
+        return found
+
+    def rating_history(self, name, count=None):
+        """ The last count (game_id, field size, finish, mu, sigma, skill) of the bot, oldest first """
+        rows = self.retrieve("select game_id, field_size, finish, mu, sigma, skill from rating_history where name=? order by id desc limit ?", (name, count or self.rating_history_length))
+        return rows[::-1]
+
+    def queue_match(self, match):
+        """ Add a planned match to the match queue and remember its id on the match """
+        with self.transaction(counted=False):
+            cursor = self.db.cursor()
+            cursor.execute("INSERT INTO match_queue (state, width, height, map_seed, players, created, updated) VALUES ('planned',?,?,?,?,?,?)", (match.width, match.height, match.map_seed, json.dumps([p.name for p in match.players]), time.time(), time.time()))
+            match.queue_id = cursor.lastrowid
+
+    def complete_queued(self, match):
+        if match.queue_id is not None:
+            with self.transaction(counted=False):
+                self.update_deferred("UPDATE match_queue SET state='completed', outcome=?, updated=? WHERE id=? AND state='planned'", (json.dumps(match.outcome()), time.time(), match.queue_id))
+
+    def apply_queued(self, match, game_id):
+        """ Mark the match as applied; call it in the same transaction as the rating update """
+        if match.queue_id is not None:
+            self.update_deferred("UPDATE match_queue SET state='applied', game_id=?, updated=? WHERE id=?", (game_id, time.time(), match.queue_id))
+
+    def drop_queued(self, queue_id):
+        self.update("UPDATE match_queue SET state='dropped', updated=? WHERE id=?", (time.time(), queue_id))
+
+    def unapplied_matches(self):
+        """ (id, state, width, height, seed, player names, outcome) of every queued match that
+        was never applied, in the order they were planned.  A planned match may have been
+        running when the manager stopped; it is simply played again. """
+        rows = self.retrieve("select id, state, width, height, map_seed, players, outcome from match_queue where state in ('planned', 'completed') order by id")
+        return [(queue_id, state, width, height, seed, json.loads(names), outcome and json.loads(outcome)) for queue_id, state, width, height, seed, names, outcome in rows]
+
+    def load_players(self, active_only=True):
+        sql = "select * from players where active > 0" if active_only else "select * from players"
+        return PlayerRegistry(parse_player_record(p) for p in self.retrieve(sql))
+
+    def find_cached_result(self, key):
+        found = self.retrieve("select results, replay_file from result_cache where key=?", (key,))
+        return found[0] if found else None
+
+    def cache_result(self, key, match, game_id):
+        self.update("insert or replace into result_cache (key, results, replay_file, game_id, created) values (?,?,?,?,?)", (key, json.dumps(match.results), match.replay_file, game_id, time.time()))
 
     def add_player(self, name, path, active=True):
         self.update("insert into players values(?,?,?,?,?,?,?,?,?,?)", (None, name, path, self.now(), 1000, 0.0, 25.0, 25.0/3.0, 0, active))
@@ -292,9 +1895,62 @@ class Database:
         self.update("update players set rank=? where name=?", (rank, name))
 
     def update_player_ranks(self):
-        for i, p in enumerate(self.retrieve("select name from players order by skill desc",())):
-            self.update_player_rank( p[0], i+1 )
+        # one statement for the whole table, touching only the rows whose rank actually moved
+        if sqlite3.sqlite_version_info >= (3, 33, 0):
+            self.update("update players set rank=ranked.new_rank from (select id, row_number() over (order by skill desc) as new_rank from players) as ranked where players.id=ranked.id and players.rank!=ranked.new_rank")
+        else:
+            ranks = [(i+1, p[0], i+1) for i, p in enumerate(self.retrieve("select id from players order by skill desc",()))]
+            self.update_many("update players set rank=? where id=? and rank!=?", ranks)
         
+    def rerate(self, engine, batch_size=10000):
+        """ Replay the whole games table through engine, starting everyone from a fresh rating,
+        and write the new ratings (and rating history) back in a single transaction.  Returns
+        the number of games. """
+        ratings, history, games = self.replay_ratings(engine, batch_size)
+        default = Player("", "")
+        with self.transaction():
+            self.update("update players set skill=?, mu=?, sigma=?, ngames=0", (default.skill, default.mu, default.sigma))
+            self.update_many("update players set skill=?, mu=?, sigma=?, ngames=? where name=?", ((mu - sigma * 3, mu, sigma, ngames, name) for name, (mu, sigma, ngames) in ratings.items()))
+            self.update_player_ranks()
+            self.replace_rating_history(history)
+        self.commit()
+        return games
+
+    def replay_ratings(self, engine, batch_size=10000):
+        """ Rate the whole games table through engine from fresh ratings.  Rows are streamed in
+        game order and only the running ratings and the last rating_history_length games of
+        each bot are kept in memory.  Returns ({name: (mu, sigma, games)}, {name: rating
+        history, as replace_rating_history takes it}, number of games). """
+        ratings = {}
+        history = collections.defaultdict(lambda: collections.deque(maxlen=self.rating_history_length))
+        default = Player("", "")
+        games = 0
+        def rate(game_id, names, ranks):
+            current = [ratings.get(name, (default.mu, default.sigma, 0)) for name in names]
+            updated = engine.rate([(mu, sigma) for mu, sigma, _ in current], ranks)
+            for name, rank, (mu, sigma), (_, _, ngames) in zip(names, ranks, updated, current):
+                ratings[name] = (mu, sigma, ngames + 1)
+                history[name].append((game_id, len(names), rank, mu, sigma))
+        cursor = self.db.cursor()
+        cursor.execute("select game_id, name, finish from games order by game_id, id")
+        game_id, names, ranks = None, [], []
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row_game_id, name, finish in rows:
+                if row_game_id != game_id and names:
+                    rate(game_id, names, ranks)
+                    games += 1
+                    names, ranks = [], []
+                game_id = row_game_id
+                names.append(name)
+                ranks.append(finish)
+        if names:
+            rate(game_id, names, ranks)
+            games += 1
+        return ratings, history, games
+
     def activate_player(self, name):
         self.update("update players set active=? where name=?", (1, name))
 
@@ -310,7 +1966,7 @@ class Database:
             # blow out database
             self.db.close()
             os.remove(filename)
-            self.db = sqlite3.connect(filename)
+            self.connect(filename)
             self.recreate()
             for player in players:
                 self.add_player(player.name, player.path, player.active)
@@ -318,6 +1974,8 @@ class Database:
 
 
 class Player:
+    __slots__ = ("name", "path", "last_seen", "rank", "skill", "mu", "sigma", "ngames", "active")
+
     def __init__(self, name, path, last_seen = "", rank = 1000, skill = 0.0, mu = 25.0, sigma = (25.0 / 3.0), ngames = 0, active = 1):
         self.name = name
         self.path = path
@@ -335,11 +1993,556 @@ class Player:
     def update_skill(self):
         self.skill = self.mu - (self.sigma * 3)
 
+
+class PlayerRegistry:
+    """ The players taking part in a run, indexed by name.  A heap keyed on sigma finds the
+    least certain player without scanning the pool; call touch() whenever a rating changes. """
+    def __init__(self, players=()):
+        self.by_name = {}
+        self.pool = []
+        self.sigma_heap = []
+        for player in players:
+            self.add(player)
+
+    def __len__(self):
+        return len(self.pool)
+
+    def __iter__(self):
+        return iter(self.pool)
+
+    def __getitem__(self, name):
+        return self.by_name[name]
+
+    def add(self, player):
+        self.by_name[player.name] = player
+        self.pool.append(player)
+        self.touch(player)
+
+    def touch(self, player):
+        heapq.heappush(self.sigma_heap, (-player.sigma, player.name))
+        if len(self.sigma_heap) > 4 * len(self.pool) + 16:
+            self.sigma_heap = [(-p.sigma, p.name) for p in self.pool]
+            heapq.heapify(self.sigma_heap)
+
+    def highest_sigma(self, exclude=()):
+        """ The least certain player, passing over the names in exclude unless that leaves nobody """
+        found = None
+        skipped = []
+        while found is None and self.sigma_heap:
+            neg_sigma, name = self.sigma_heap[0]
+            player = self.by_name[name]
+            if player.sigma != -neg_sigma:
+                heapq.heappop(self.sigma_heap)    # stale entry from before the last rating update
+            elif name in exclude:
+                skipped.append(heapq.heappop(self.sigma_heap))
+            else:
+                found = player
+        for entry in skipped:
+            heapq.heappush(self.sigma_heap, entry)
+        return found or self.highest_sigma()
+
+    def sample(self, num, exclude=()):
+        """ num distinct random players, none of them in exclude """
+        picked = [p for p in random.sample(self.pool, min(len(self.pool), num + len(exclude))) if p not in exclude]
+        return picked[:num]
+
+class Leaderboard:
+    """ A ranking table kept in memory and redrawn at most every refresh_seconds seconds or
+    refresh_matches matches.  Each refresh shows the top bots plus any others whose rating
+    changed since the last one, built as a single write. """
+    def __init__(self, players, top=20, refresh_seconds=0.0, refresh_matches=1):
+        self.players = players
+        self.top = top
+        self.refresh_seconds = refresh_seconds
+        self.refresh_matches = refresh_matches
+        self.order = sorted((-p.skill, p.name) for p in players)
+        self.skill = {p.name: p.skill for p in players}
+        self.shown = dict(self.skill)
+        self.changed = set()
+        self.matches = 0
+        self.last_refresh = time.monotonic()
+
+    def update(self, players):
+        for player in players:
+            self.order.pop(bisect.bisect_left(self.order, (-self.skill[player.name], player.name)))
+            bisect.insort(self.order, (-player.skill, player.name))
+            self.skill[player.name] = player.skill
+            self.changed.add(player.name)
+        self.matches += 1
+        if self.matches >= self.refresh_matches and time.monotonic() - self.last_refresh >= self.refresh_seconds:
+            self.show()
+
+    def show(self):
+        lines = ["", "{:>5}  {:<25}{:>10}{:>10}{:>10}{:>10}".format("rank", "name", "skill", "mu", "sigma", "change")]
+        shown = 0
+        for rank, (_, name) in enumerate(self.order[:self.top], 1):
+            lines.append(self.format_row(rank, name))
+            shown += 1
+        others = sorted(bisect.bisect_left(self.order, (-self.skill[name], name)) + 1 for name in self.changed)
+        others = [rank for rank in others if rank > self.top]
+        if others:
+            lines.append("  ...")
+            lines.extend(self.format_row(rank, self.order[rank - 1][1]) for rank in others)
+        sys.stdout.write("\n".join(lines) + "\n\n")
+        sys.stdout.flush()
+        for name in self.changed:
+            self.shown[name] = self.skill[name]
+        self.changed.clear()
+        self.matches = 0
+        self.last_refresh = time.monotonic()
+
+    def format_row(self, rank, name):
+        player = self.players[name]
+        change = player.skill - self.shown[name]
+        marker = "*" if name in self.changed else " "
+        return "{:>5}{} {:<25}{:10.4f}{:10.4f}{:10.4f}{:+10.4f}".format(rank, marker, name, player.skill, player.mu, player.sigma, change)
+
+
+class SigmaScheduler:
+    """ Random lineups; with priority_sigma the least certain player is always included """
+    def __init__(self, priority_sigma=True):
+        self.priority_sigma = priority_sigma
+
+    def pick(self, players, num, busy=()):
+        """ busy names the bots already in planned or running matches: they aren't made the
+        anchor again, and are only drawn when there aren't enough idle bots """
+        contestants = list()
+        if self.priority_sigma:
+            contestants.append(players.highest_sigma(exclude=busy))
+        exclude = contestants + [players[name] for name in busy if name in players.by_name]
+        if len(players) - len(exclude) < num - len(contestants):
+            exclude = contestants
+        contestants.extend(players.sample(num - len(contestants), exclude=exclude))
+        random.shuffle(contestants)
+        return contestants
+
+    def rated(self, players):
+        pass
+
+
+class QualityScheduler:
+    """ Lineups chosen for how much a game between them should tell us.  The least certain
+    player is the anchor; candidate lineups are drawn from the opponents closest to it in
+    TrueSkill terms and scored by match quality (the TrueSkill draw probability) times the
+    total variance at stake, and the best candidate is played. """
+    def __init__(self, candidates=64, beta=25.0 / 6.0):
+        import numpy
+        self.np = numpy
+        self.candidates = candidates
+        self.beta = beta
+        self.rng = numpy.random.default_rng()
+        self.index = None
+
+    def load(self, players):
+        np = self.np
+        self.pool = list(players)
+        self.index = {player.name: i for i, player in enumerate(self.pool)}
+        self.mu = np.array([player.mu for player in self.pool])
+        self.sigma = np.array([player.sigma for player in self.pool])
+
+    def rated(self, players):
+        if self.index is None:
+            return
+        for player in players:
+            i = self.index[player.name]
+            self.mu[i] = player.mu
+            self.sigma[i] = player.sigma
+
+    def pick(self, players, num, busy=()):
+        np = self.np
+        if self.index is None or len(self.pool) != len(players):
+            self.load(players)
+        num = min(num, len(self.pool))
+        anchor = self.index[players.highest_sigma(exclude=busy).name]
+        beta2 = self.beta ** 2
+        var = self.sigma ** 2
+        # pairwise quality of every player against the anchor, weighted by what they stand to learn
+        c2 = 2 * beta2 + var[anchor] + var
+        weight = np.sqrt(2 * beta2 / c2) * np.exp(-(self.mu - self.mu[anchor]) ** 2 / (2 * c2)) * var
+        weight = np.maximum(weight, 1e-12)
+        for name in busy:
+            if name in self.index:
+                weight[self.index[name]] = 1e-12     # only if there aren't enough idle opponents
+        weight[anchor] = 0.0
+        weight /= weight.sum()
+        lineups = np.empty((self.candidates, num), dtype=int)
+        lineups[:, 0] = anchor
+        for c in range(self.candidates):
+            lineups[c, 1:] = self.rng.choice(len(self.pool), size=num - 1, replace=False, p=weight)
+        best = lineups[np.argmax(self.lineup_scores(lineups))]
+        contestants = [self.pool[i] for i in best]
+        random.shuffle(contestants)
+        return contestants
+
+    def lineup_scores(self, lineups):
+        """ Match quality of each lineup (rows of pool indices) times its total variance """
+        np = self.np
+        mu = self.mu[lineups]
+        var = self.sigma[lineups] ** 2
+        n = lineups.shape[1]
+        a = np.zeros((n, n - 1))
+        a[np.arange(n - 1), np.arange(n - 1)] = 1.0
+        a[np.arange(1, n), np.arange(n - 1)] = -1.0
+        base = self.beta ** 2 * (a.T @ a)
+        spread = base + np.einsum("ji,cj,jk->cik", a, var, a)
+        a_mu = mu @ a
+        solved = np.linalg.solve(spread, a_mu[:, :, None])[:, :, 0]
+        exponent = -0.5 * np.einsum("ci,ci->c", a_mu, solved)
+        quality = np.sqrt(np.linalg.det(base) / np.linalg.det(spread)) * np.exp(exponent)
+        return quality * var.sum(axis=1)
+
+
 def parse_player_record (player):
     (player_id, name, path, last_seen, rank, skill, mu, sigma, ngames, active) = player
     return Player(name, path, last_seen, rank, skill, mu, sigma, ngames, active)
     
 
+class MatchDispatcher:
+    """ The coordinator's side of distributed play: planned matches wait here until a worker
+    leases one, and come back through completed once its result is in.  A worker must renew
+    its lease while it plays; a lease that runs out puts the match back in the queue, and any
+    result that arrives for it later is refused.  A match that has been leased max_attempts
+    times without a usable result is given up on and comes back through dropped. """
+    def __init__(self, lease_seconds=120.0, max_attempts=3):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.pending = collections.deque()
+        self.leases = {}            # lease id -> [match, deadline, worker]
+        self.attempts = collections.Counter()
+        self.completed = queue.Queue()
+        self.dropped = queue.Queue()
+
+    def submit(self, match):
+        with self.lock:
+            self.pending.append(match)
+
+    def in_flight(self):
+        with self.lock:
+            return len(self.pending) + len(self.leases)
+
+    def cancel_pending(self):
+        with self.lock:
+            cancelled = len(self.pending)
+            self.pending.clear()
+        return cancelled
+
+    def lease(self, worker):
+        with self.lock:
+            if not self.pending:
+                return None, None
+            match = self.pending.popleft()
+            self.attempts[match] += 1
+            lease_id = secrets.token_hex(16)    # unguessable, and never reused by a restarted coordinator
+            self.leases[lease_id] = [match, time.monotonic() + self.lease_seconds, worker]
+        print("Match leased to %s (lease %s)" % (worker, lease_id))
+        return lease_id, match
+
+    def renew(self, lease_id):
+        with self.lock:
+            if lease_id not in self.leases:
+                return False
+            self.leases[lease_id][1] = time.monotonic() + self.lease_seconds
+            return True
+
+    def complete(self, lease_id, seed, seats):
+        """ Take the match off its lease.  None if the lease has expired, or if seed and seats
+        don't match the leased match (the lease is then left alone). """
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            if lease is None or lease[0].map_seed != seed or lease[0].num_players != seats:
+                return None
+            del self.leases[lease_id]
+        return lease[0]
+
+    def finish(self, match):
+        """ Hand a match with its result over to the coordinating thread """
+        with self.lock:
+            del self.attempts[match]
+        self.completed.put(match)
+
+    def retry(self, match):
+        """ Put a match back at the head of the queue after a failed lease, unless it has had its attempts """
+        with self.lock:
+            if self.attempts[match] < self.max_attempts:
+                self.pending.appendleft(match)
+                return
+            del self.attempts[match]
+        print("Giving up on a match after %d failed leases" % self.max_attempts)
+        self.dropped.put(match)
+
+    def requeue_expired(self):
+        now = time.monotonic()
+        with self.lock:
+            expired = [(lease_id, self.leases.pop(lease_id)) for lease_id, (_, deadline, _) in list(self.leases.items()) if deadline < now]
+        for lease_id, (match, _, worker) in expired:
+            print("Lease %s held by %s expired" % (lease_id, worker))
+            self.retry(match)
+
+
+class MatchDispatchHandler:
+    """ HTTP front end for a MatchDispatcher (server.dispatcher), mixed into
+    http.server.BaseHTTPRequestHandler by start_coordinator.
+        POST /lease                 {"worker": name} -> a match spec as JSON, or 204 if there is no work
+        POST /renew?lease=ID        -> 200, or 410 if the lease is gone
+        POST /result?lease=ID       one line of JSON (output, usage), then the replay, gzip compressed """
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        length = int(self.headers.get("Content-Length", 0))
+        dispatcher = self.server.dispatcher
+        if url.path == "/lease":
+            worker = json.loads(self.rfile.read(length) or b"{}").get("worker", self.client_address[0])
+            lease_id, match = dispatcher.lease(worker)
+            if match is None:
+                self.send_response(204)
+                self.end_headers()
+                return
+            spec = {"lease": lease_id, "width": match.width, "height": match.height, "seed": match.map_seed,
+                    "time_limit": match.total_time_limit, "players": [[p.name, p.path] for p in match.players]}
+            self.send_json(spec)
+        elif url.path == "/renew":
+            self.send_response(200 if dispatcher.renew(query["lease"][0]) else 410)
+            self.end_headers()
+        elif url.path == "/result":
+            self.receive_result(dispatcher, query["lease"][0], length)
+        else:
+            self.send_error(404)
+
+    def receive_result(self, dispatcher, lease_id, length):
+        line = self.rfile.readline(length)
+        remaining = length - len(line)
+        result = json.loads(line)
+        match = dispatcher.complete(lease_id, result.get("seed"), len(result.get("bot_usage") or ()))
+        if match is None:
+            while remaining > 0:
+                remaining -= len(self.rfile.read(min(remaining, ReplayStore.chunk_size)))
+            self.send_response(410)
+            self.end_headers()
+            return
+        try:
+            for name in ("wall_time", "cpu_time", "peak_rss", "bot_usage", "status"):
+                setattr(match, name, result[name])
+            if match.status != "timeout":
+                match.finish_match(result["output"].encode('ascii'), result["return_code"])
+                # the replay arrives compressed; unpack it under a name of our own choosing (never the
+                # one in the worker's output, which could point at any file here) for store_replay to archive
+                directory = match.replay_store.directory if match.replay_store else replay_dir
+                os.makedirs(directory, exist_ok=True)
+                match.replay_file = os.path.join(directory, "%d-%s.hlt" % (match.map_seed, lease_id))
+                decompressor = zlib.decompressobj(wbits=31)
+                with open(match.replay_file, 'wb') as f:
+                    while remaining > 0:
+                        chunk = self.rfile.read(min(remaining, ReplayStore.chunk_size))
+                        if not chunk:
+                            break
+                        remaining -= len(chunk)
+                        f.write(decompressor.decompress(chunk))
+                    f.write(decompressor.flush())
+        except Exception as e:
+            print("Bad result for lease %s: %s" % (lease_id, repr(e)))
+            dispatcher.retry(match)
+            self.send_response(400)
+            self.end_headers()
+            return
+        dispatcher.finish(match)
+        self.send_response(200)
+        self.end_headers()
+
+    def send_json(self, value):
+        data = json.dumps(value).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_coordinator(port, lease_seconds):
+    import http.server
+    handler = type("MatchDispatchHandler", (MatchDispatchHandler, http.server.BaseHTTPRequestHandler), {})
+    server = http.server.ThreadingHTTPServer(("", port), handler)
+    server.dispatcher = MatchDispatcher(lease_seconds)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("Coordinator listening on port %d" % server.server_address[1])
+    return server
+
+
+def run_worker(url, halite_binary, name, stager=None, stop_requested=lambda: False):
+    """ Lease matches from the coordinator at url, play them locally and send back the results """
+    import urllib.request
+    url = url.rstrip("/")
+    delay = 1.0
+    while not stop_requested():
+        try:
+            request = urllib.request.Request(url + "/lease", json.dumps({"worker": name}).encode(), {"Content-Type": "application/json"})
+            with urllib.request.urlopen(request, timeout=30) as response:
+                spec = json.loads(response.read()) if response.status == 200 else None
+            delay = 1.0
+        except OSError as e:
+            print("Coordinator %s unreachable (%s), retrying in %d seconds" % (url, e, delay))
+            time.sleep(delay)
+            delay = min(delay * 2, 30.0)
+            continue
+        if spec is None:
+            time.sleep(2.0)
+            continue
+        try:
+            play_leased_match(url, halite_binary, spec, stager)
+        except Exception as e:
+            # the lease is no longer renewed, so the coordinator will hand the match out again
+            print("Match for lease %s failed: %s" % (spec["lease"], repr(e)))
+
+
+def play_leased_match(url, halite_binary, spec, stager=None):
+    import tempfile
+    import urllib.request
+    lease = "?lease=" + spec["lease"]
+    players = [Player(player_name, path) for player_name, path in spec["players"]]
+    done = threading.Event()
+    def renew():
+        while not done.wait(10.0):
+            try:
+                urllib.request.urlopen(urllib.request.Request(url + "/renew" + lease, b""), timeout=30).close()
+            except OSError as e:
+                print("Could not renew lease %s: %s" % (spec["lease"], e))
+    renewer = threading.Thread(target=renew, daemon=True)
+    renewer.start()
+    with tempfile.TemporaryDirectory() as directory:
+        m = Match(players, spec["width"], spec["height"], spec["seed"], spec["time_limit"], ReplayStore(directory))
+        if stager:
+            m.paths = [stager.stage(path) for path in m.paths]
+        try:
+            print(m)
+            m.run_match(halite_binary)
+        finally:
+            done.set()
+            renewer.join()
+        result = {"output": m.results_string, "return_code": m.return_code, "wall_time": m.wall_time, "cpu_time": m.cpu_time,
+                  "peak_rss": m.peak_rss, "bot_usage": m.bot_usage, "status": m.status, "seed": m.map_seed}
+        header = (json.dumps(result) + "\n").encode()
+        send_result(url + "/result" + lease, header, m.replay_file if m.status != "timeout" else os.devnull, spec["lease"])
+
+
+def send_result(url, header, replay_file, lease_id, attempts=4):
+    """ POST header and the replay to url, retrying with backoff while the coordinator is
+    unreachable; after attempts tries the result is dropped and the lease left to expire """
+    import urllib.request
+    delay = 1.0
+    for attempt in range(attempts):
+        with open(replay_file, 'rb') as replay:
+            length = len(header) + os.fstat(replay.fileno()).st_size
+            body = itertools.chain([header], iter(lambda: replay.read(ReplayStore.chunk_size), b''))
+            request = urllib.request.Request(url, body, {"Content-Length": str(length)})
+            try:
+                urllib.request.urlopen(request, timeout=60).close()
+                print("Result sent for lease %s" % lease_id)
+                return True
+            except urllib.error.HTTPError as e:
+                print("Result for lease %s refused (%d)" % (lease_id, e.code))
+                return False
+            except OSError as e:
+                print("Could not send the result for lease %s (%s)" % (lease_id, e))
+        if attempt + 1 < attempts:
+            time.sleep(delay)
+            delay *= 2
+    print("Dropping the result for lease %s" % lease_id)
+    return False
+
+
+benchmark_halite = """#!%s
+# Stand-in for the halite binary: plays no game, but prints the same JSON and writes a replay
+import json, random, sys, time
+bots = sys.argv[4:]
+ranks = list(range(1, len(bots) + 1))
+random.shuffle(ranks)
+replay = "%s/%%d-%%d.hlt" %% (time.time() * 1e6, random.getrandbits(32))
+with open(replay, "w") as f:
+    json.dump({"version": 11, "num_players": len(bots), "frames": [[[[random.randint(0, len(bots)), random.randint(0, 255)] for x in range(30)] for y in range(30)] for t in range(%d)]}, f)
+print(json.dumps({"replay": replay, "stats": {str(i): {"rank": r} for i, r in enumerate(ranks)}}))
+"""
+
+def run_benchmark(pools, match_counts, output=None, player_dist=(2, 3, 4, 5, 6), top=None, replay_frames=10):
+    """ Run the whole match pipeline against a stub halite binary and report how long the
+    manager itself spends in each stage, per pool size and number of matches """
+    import tempfile
+    report = {"python": sys.version.split()[0], "sqlite": sqlite3.sqlite_version, "started": datetime.datetime.now().isoformat(), "runs": []}
+    for pool in pools:
+        for matches in match_counts:
+            with tempfile.TemporaryDirectory() as directory:
+                stub = os.path.join(directory, "halite")
+                with open(stub, "w") as f:
+                    f.write(benchmark_halite % (sys.executable, directory, replay_frames))
+                os.chmod(stub, 0o755)
+                manager = Manager(stub, os.path.join(directory, "bench.sqlite3"))
+                with manager.db.transaction():
+                    for i in range(pool):
+                        manager.db.add_player("bot%d" % i, "bot%d" % i)
+                manager.players = manager.db.load_players()
+                if top is not None:
+                    manager.leaderboard = Leaderboard(manager.players, top)
+                manager.replay_store = ReplayStore(os.path.join(directory, "replays"))
+                manager.rounds = matches
+                manager.timings = {}
+                start = time.perf_counter()
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                    manager.run_rounds_until(lambda: False, list(player_dist), None)
+                elapsed = time.perf_counter() - start
+                manager.db.db.close()
+            stages = {}
+            for name, times in manager.timings.items():
+                times.sort()
+                stages[name] = {"count": len(times), "total": sum(times), "mean": sum(times) / len(times), "p50": percentile(times, 50), "p95": percentile(times, 95), "max": times[-1]}
+            overhead = sum(stage["total"] for name, stage in stages.items() if name != "halite")
+            run = {"pool": pool, "matches": matches, "elapsed": elapsed, "matches_per_second": matches / elapsed, "overhead_per_match": overhead / matches, "stages": stages}
+            report["runs"].append(run)
+            print("pool %5d, %5d matches: %7.2f matches/s, manager overhead %8.3f ms/match" % (pool, matches, run["matches_per_second"], 1000 * run["overhead_per_match"]))
+            for name in sorted(stages):
+                stage = stages[name]
+                print("    %-8s mean %8.3f ms   p50 %8.3f ms   p95 %8.3f ms" % (name, 1000 * stage["mean"], 1000 * stage["p50"], 1000 * stage["p95"]))
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Benchmark results saved to %s" % output)
+    return report
+
+
+def run_startup_benchmark(runs=20, output=None, pool=100):
+    """ Time the read-only commands from a cold start, each in a fresh interpreter, against a
+    database of pool bots; a bare interpreter start is timed alongside for reference """
+    import tempfile
+    script = os.path.abspath(__file__)
+    report = {"python": sys.version.split()[0], "sqlite": sqlite3.sqlite_version, "started": datetime.datetime.now().isoformat(), "commands": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        db_filename = os.path.join(directory, "bench.sqlite3")
+        database = Database(db_filename)
+        with database.transaction():
+            for i in range(pool):
+                database.add_player("bot%d" % i, "bot%d" % i)
+        database.commit()
+        database.db.close()
+        commands = [("python", [sys.executable, "-c", "pass"])]
+        commands += [(args, [sys.executable, script, "--db", db_filename] + args.split()) for args in ("-t", "-r", "--perf")]
+        with open(os.devnull, "w") as devnull:
+            for name, command in commands:
+                times = []
+                for _ in range(runs):
+                    start = time.perf_counter()
+                    Popen(command, stdout=devnull, cwd=directory).wait()
+                    times.append(time.perf_counter() - start)
+                times.sort()
+                report["commands"][name] = {"runs": runs, "min": times[0], "p50": percentile(times, 50), "p95": percentile(times, 95)}
+                print("%-8s min %7.1f ms   p50 %7.1f ms   p95 %7.1f ms" % (name, 1000 * times[0], 1000 * percentile(times, 50), 1000 * percentile(times, 95)))
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Benchmark results saved to %s" % output)
+    return report
+
+
 class Commandline:
     def __init__(self):
         #self.manager is created after we know the db_filename, so first two lines of Commandline.act() method
@@ -370,10 +2573,30 @@ class Commandline:
                                  action = "store_true", default = False,
                                  help = "Show a list of all bots, ordered by skill")
 
-        self.parser.add_argument("-t", "--showRanksTsv", dest="showRanksTsv",
+        self.parser.add_argument("-t", "--showRanksTsv", "--tsv", dest="showRanksTsv",
                                  action = "store_true", default = False,
                                  help = "Show a list of all bots ordered by skill, with headings in TSV format like the rest of the data")
 
+        self.parser.add_argument("--perf", dest="perf",
+                                 action = "store", default = None, nargs = "*", metavar = "BOT",
+                                 help = "Show p50/p95/p99 wall time, cpu time and peak memory per bot (all bots, or the ones named)")
+
+        self.parser.add_argument("--replay-stats", dest="replayStats",
+                                 action = "store", default = None, nargs = "*", metavar = "BOT",
+                                 help = "Summarise the analysed replays per bot (all bots, or the ones named): how often and how early it was eliminated, its peak and final territory and final strength")
+
+        self.parser.add_argument("--stats", dest="stats",
+                                 action = "store", default = None, nargs = "*", metavar = "BOT",
+                                 help = "Show win rate, average finish and recent form per bot (all bots, or the ones named, with their head-to-head record and finishes by map size)")
+
+        self.parser.add_argument("--rebuild-stats", dest="rebuildStats",
+                                 action = "store_true", default = False,
+                                 help = "Recompute the tables behind --stats from the stored game history (the rating history is replayed with --rating-engine)")
+
+        self.parser.add_argument("--analyze-replays", dest="analyzeReplays",
+                                 action = "store_true", default = False,
+                                 help = "Extract per-turn territory, strength and production for every player from the archived replays not analysed yet, including those of matches recorded before replays were indexed (uses --jobs processes)")
+
         self.parser.add_argument("-m", "--match", dest="match",
                                  action = "store_true", default = False,
                                  help = "Run a single match")
@@ -384,16 +2607,172 @@ class Commandline:
 
         self.parser.add_argument("-v", "--view", dest="view",
                                  action = "store", default = "",
-                                 help = "View a replay in the web browser")
+                                 help = "View a replay in the web browser (served from a local HTTP server until Ctrl-C)")
+
+        self.parser.add_argument("--h2h", dest="headToHead",
+                                 action = "store", default = None, nargs = 2, metavar = ("BOT_A", "BOT_B"),
+                                 help = "Play BOT_A against BOT_B in pairs of games (same map, seats swapped) until a sequential probability ratio test decides whether BOT_A is stronger")
+
+        self.parser.add_argument("--elo0", dest="elo0",
+                                 action = "store", default = 0.0, type = float,
+                                 help = "Elo difference of the null hypothesis for --h2h (default 0)")
+
+        self.parser.add_argument("--elo1", dest="elo1",
+                                 action = "store", default = 30.0, type = float,
+                                 help = "Elo difference of the alternative hypothesis for --h2h (default 30)")
+
+        self.parser.add_argument("--alpha", dest="alpha",
+                                 action = "store", default = 0.05, type = float,
+                                 help = "False positive rate for --h2h (default 0.05)")
+
+        self.parser.add_argument("--beta-error", dest="betaError",
+                                 action = "store", default = 0.05, type = float,
+                                 help = "False negative rate for --h2h (default 0.05)")
+
+        self.parser.add_argument("--max-games", dest="maxGames",
+                                 action = "store", default = 1000, type = int,
+                                 help = "Stop --h2h after this many games even if the test is undecided, timed out games included (default 1000).  It also stops after 3 pairs in a row with a timed out match")
+
+        self.parser.add_argument("-j", "--jobs", dest="jobs",
+                                 action = "store", default = 1, type = int,
+                                 help = "Number of matches to run at the same time")
+
+        self.parser.add_argument("--pin-cpus", dest="pinCpus",
+                                 action = "store_true", default = False,
+                                 help = "Give each running match its own CPUs (one for halite plus one per bot), and only start a match once enough are free.  Matches are started under taskset; without it halite is pinned just after it starts, and a bot it launches at once may escape the pinning")
+
+        self.parser.add_argument("--adaptive-timeouts", dest="adaptiveTimeouts",
+                                 action = "store_true", default = False,
+                                 help = "Give each match a deadline learned from earlier matches on the same map size with the same lineup (or player count): their 99th percentile duration times --timeout-margin")
+
+        self.parser.add_argument("--timeout-margin", dest="timeoutMargin",
+                                 action = "store", default = 2.0, type = float,
+                                 help = "Multiplier on the learned match duration for --adaptive-timeouts (default 2)")
+
+        self.parser.add_argument("--async", dest="asyncRunner",
+                                 action = "store_true", default = False,
+                                 help = "Run matches on an asyncio event loop (stops as soon as a key is pressed, then waits for running matches)")
+
+        self.parser.add_argument("--group-commit", dest="groupCommit",
+                                 action = "store", default = 1, type = int,
+                                 help = "Commit the results of this many matches to the database at once (useful with --jobs)")
+
+        self.parser.add_argument("--serve-replays", dest="serveReplays",
+                                 action = "store", default = None, type = int, nargs = "?", const = 8000, metavar = "PORT",
+                                 help = "Serve the replay archive and visualizer over HTTP on localhost (default port 8000)")
+
+        self.parser.add_argument("--coordinator", dest="coordinator",
+                                 action = "store", default = None, type = int, metavar = "PORT",
+                                 help = "With -m or -f, hand matches out to --worker processes connecting on this port instead of playing them locally (-j sets how many are out at once)")
+
+        self.parser.add_argument("--worker", dest="worker",
+                                 action = "store", default = "", metavar = "URL",
+                                 help = "Play matches for the coordinator at URL (e.g. http://buildbox:8001); -j sets how many at once")
+
+        self.parser.add_argument("--worker-name", dest="workerName",
+                                 action = "store", default = "",
+                                 help = "Name this worker reports to the coordinator (default: host name and process id)")
+
+        self.parser.add_argument("--lease-seconds", dest="leaseSeconds",
+                                 action = "store", default = 120.0, type = float,
+                                 help = "How long a coordinator waits to hear from a worker before requeueing its match")
+
+        self.parser.add_argument("--stage-bots", dest="stageBots",
+                                 action = "store", default = "", nargs = "?", const = "staging", metavar = "DIR",
+                                 help = "Snapshot every bot into a content-hashed directory (default: staging) when the run starts, byte-compile Python bots, and launch them from there")
 
         self.parser.add_argument("-n", "--no-replays", dest="deleteReplays",
                                  action = "store_true", default = False,
                                  help = "Do not store replays")
 
+        self.parser.add_argument("--replay-compression", dest="replayCompression",
+                                 action = "store", default = "gzip", choices = ("gzip", "zstd", "none"),
+                                 help = "How to compress stored replays (zstd needs the zstandard module)")
+
+        self.parser.add_argument("--prune-replays", dest="pruneReplays",
+                                 action = "store_true", default = False,
+                                 help = "Delete stored replays not kept by --keep-days, --keep-top or --keep-upsets")
+
+        self.parser.add_argument("--keep-days", dest="keepDays",
+                                 action = "store", default = None, type = float,
+                                 help = "With --prune-replays, keep replays from the last N days")
+
+        self.parser.add_argument("--keep-top", dest="keepTop",
+                                 action = "store", default = None, type = int,
+                                 help = "With --prune-replays, keep replays involving the N highest ranked bots")
+
+        self.parser.add_argument("--keep-upsets", dest="keepUpsets",
+                                 action = "store_true", default = False,
+                                 help = "With --prune-replays, keep replays where the winner is rated below a bot it beat")
+
         self.parser.add_argument("-e", "--equal-priority", dest="equalPriority",
                                  action = "store_true", default = False,
                                  help = "Equal priority for all active bots (otherwise highest sigma will always be selected)")
 
+        self.parser.add_argument("--scheduler", dest="scheduler",
+                                 action = "store", default = "sigma", choices = ("sigma", "quality"),
+                                 help = "How lineups are chosen: sigma (random, plus the highest sigma bot unless -e) or quality (best expected match quality and information gain, needs numpy)")
+
+        self.parser.add_argument("--rating-engine", dest="ratingEngine",
+                                 action = "store", default = "fast", choices = sorted(rating_engines),
+                                 help = "TrueSkill implementation: fast (built in) or skills (the reference skills package)")
+
+        self.parser.add_argument("--beta", dest="beta",
+                                 action = "store", default = 25.0 / 6.0, type = float,
+                                 help = "TrueSkill beta: the performance spread within a single game")
+
+        self.parser.add_argument("--tau", dest="tau",
+                                 action = "store", default = 25.0 / 300.0, type = float,
+                                 help = "TrueSkill tau: how much a skill may drift between games")
+
+        self.parser.add_argument("--draw-probability", dest="drawProbability",
+                                 action = "store", default = 0.10, type = float,
+                                 help = "TrueSkill draw probability")
+
+        self.parser.add_argument("--rerate", dest="rerate",
+                                 action = "store_true", default = False,
+                                 help = "Recompute every rating from the stored game history (use with --rating-engine, --beta, --tau and --draw-probability)")
+
+        self.parser.add_argument("--benchmark", dest="benchmark",
+                                 action = "store_true", default = False,
+                                 help = "Measure the manager's own overhead per stage, using a stub halite binary")
+
+        self.parser.add_argument("--bench-pools", dest="benchPools", type = int,
+                                 nargs = "+", action = "store", default = [10, 100, 1000, 5000],
+                                 help = "Pool sizes (numbers of bots) for --benchmark")
+
+        self.parser.add_argument("--bench-matches", dest="benchMatches", type = int,
+                                 nargs = "+", action = "store", default = [50],
+                                 help = "Numbers of matches to play for each pool size in --benchmark")
+
+        self.parser.add_argument("--bench-output", dest="benchOutput",
+                                 action = "store", default = "",
+                                 help = "Save the --benchmark or --bench-startup results as JSON to this file")
+
+        self.parser.add_argument("--bench-startup", dest="benchStartup",
+                                 action = "store_true", default = False,
+                                 help = "Measure how long the read-only commands (-t, -r, --perf) take to start and finish, each in a fresh interpreter")
+
+        self.parser.add_argument("--check-ratings", dest="checkRatings",
+                                 action = "store_true", default = False,
+                                 help = "Compare the fast rating engine against the skills package on random games")
+
+        self.parser.add_argument("--check-replays", dest="checkReplays",
+                                 action = "store", default = None, nargs = "*", metavar = "FILE",
+                                 help = "Check the streaming replay reader behind --analyze-replays against a plain json load, reading in chunks down to 7 bytes, on the given replays or a generated one")
+
+        self.parser.add_argument("--top", dest="top",
+                                 action = "store", default = None, type = int,
+                                 help = "While running matches, show a live leaderboard of the top N bots (plus any whose rating changed) instead of the full table")
+
+        self.parser.add_argument("--refresh-seconds", dest="refreshSeconds",
+                                 action = "store", default = 0.0, type = float,
+                                 help = "Redraw the live leaderboard at most every N seconds")
+
+        self.parser.add_argument("--refresh-matches", dest="refreshMatches",
+                                 action = "store", default = 1, type = int,
+                                 help = "Redraw the live leaderboard at most every N matches")
+
         self.parser.add_argument("-E", "--exclude-inactive", dest="excludeInactive",
                                  action = "store_true", default = False,
                                  help = "Exclude inactive bots from ranking table")
@@ -420,8 +2799,20 @@ class Commandline:
                                 help = 'Use the distribution of player counts experienced by non-seed players')
 
         self.parser.add_argument('--mapdist', '--map-dist', '--map_dist', dest = 'map_dist', type = int,
-                                nargs ='*', action = 'store', default = [20, 25, 25] + [30] * 3 + [35] * 4 + [40] * 3 + [45, 45, 50],
-                                help = 'Specify a custom distribution of (square) map sizes.')
+                                nargs ='*', action = 'store', default = None,
+                                help = 'Specify a custom distribution of (square) map sizes, e.g. 20 25 25 30 30 30 35 35 35 35 40 40 40 45 45 50.  By default maps are 240 to 384 wide with a 3:2 aspect ratio.')
+
+        self.parser.add_argument('--corpus', dest = 'corpus', type = int,
+                                action = 'store', default = None,
+                                help = 'Play on a fixed corpus of N maps (sizes and seeds), chosen reproducibly from --corpus-seed')
+
+        self.parser.add_argument('--corpus-seed', dest = 'corpus_seed', type = int,
+                                action = 'store', default = 0,
+                                help = 'Seed used to generate the --corpus maps')
+
+        self.parser.add_argument('--cache-results', dest = 'cache_results',
+                                action = 'store_true', default = False,
+                                help = 'Reuse the recorded result instead of replaying a lineup already played on the same map with unchanged bot and halite binaries (only valid if halite is deterministic)')
 
     def parse(self, args):
         self.no_args = not args
@@ -436,28 +2827,139 @@ class Commandline:
     def valid_botfile(self, path):
         return True
 
+    def prepare_run(self, players):
+        self.manager.players = players
+        if self.cmds.adaptiveTimeouts:
+            self.manager.durations = MatchDurations(margin=self.cmds.timeoutMargin)
+            self.manager.durations.load(self.manager.db)
+            print("adaptive_timeouts = True (%d lineups with history)" % len(self.manager.durations.by_lineup))
+        if self.cmds.stageBots:
+            self.manager.stager = BotStager(self.cmds.stageBots)
+            for player in players:
+                self.manager.stager.stage(player.path)
+        if self.cmds.top is not None or self.cmds.refreshSeconds or self.cmds.refreshMatches > 1:
+            top = self.cmds.top if self.cmds.top is not None else 20
+            self.manager.leaderboard = Leaderboard(players, top, self.cmds.refreshSeconds, self.cmds.refreshMatches)
+
     def run_matches(self, rounds):
-        player_records = self.manager.db.retrieve("select * from players where active > 0")
-        players = [parse_player_record(player) for player in player_records]
+        players = self.manager.db.load_players()
         if len(players) < 2:
             print("Not enough players for a game. Need at least " + str(self.manager.players_min) + ", only have " + str(len(players)))
             print("use the -h flag to get help")
         else:
-            self.manager.players = players
+            self.prepare_run(players)
             self.manager.rounds = rounds
-            self.manager.run_rounds(self.cmds.player_dist, self.cmds.map_dist)
+            self.manager.resume_queue()
+            try:
+                if self.cmds.asyncRunner:
+                    self.manager.run_rounds_async(self.cmds.player_dist, self.cmds.map_dist)
+                else:
+                    self.manager.run_rounds(self.cmds.player_dist, self.cmds.map_dist)
+            finally:
+                self.manager.db.commit()
+                if self.manager.leaderboard:
+                    self.manager.leaderboard.show()
+
+    def run_head_to_head(self, name_a, name_b):
+        players = self.manager.db.load_players(active_only=False)
+        missing = [name for name in (name_a, name_b) if name not in players.by_name]
+        if missing:
+            print("Bot %s not found" % ", ".join(missing))
+        elif name_a == name_b:
+            print("A bot cannot play itself head to head")
+        else:
+            self.prepare_run(players)
+            test = SequentialTest(self.cmds.elo0, self.cmds.elo1, self.cmds.alpha, self.cmds.betaError)
+            try:
+                self.manager.run_head_to_head(name_a, name_b, test, self.cmds.maxGames, self.cmds.map_dist)
+            finally:
+                self.manager.db.commit()
+
+    def read_only_command(self):
+        """ True when act would only read the database: show ranks, --perf, --replay-stats, --stats and --view """
+        cmds = self.cmds
+        if cmds.addBot or cmds.editBot or cmds.deleteBot or cmds.activateBot or cmds.deactivateBot:
+            return False
+        if cmds.view:
+            return True
+        if cmds.rerate or cmds.benchmark or cmds.benchStartup or cmds.checkRatings or cmds.checkReplays is not None or cmds.serveReplays is not None or cmds.pruneReplays:
+            return False
+        if cmds.analyzeReplays or cmds.rebuildStats:
+            return False
+        return cmds.perf is not None or cmds.replayStats is not None or cmds.stats is not None or cmds.showRanks or cmds.showRanksTsv
+
+    def act_read_only(self):
+        """ The fast path for read-only commands: the database is opened read-only and nothing
+        else is set up.  Returns False if the database can't be used that way (it doesn't exist
+        yet, or needs upgrading), and act carries on as usual. """
+        try:
+            self.manager = Manager(halite_command, self.cmds.db_filename, read_only=True)
+        except sqlite3.Error:
+            return False
+        self.manager.exclude_inactive = self.cmds.excludeInactive
+        if self.cmds.view:
+            view_replay(self.cmds.view)
+        elif self.cmds.perf is not None:
+            self.manager.show_performance(self.cmds.perf)
+        elif self.cmds.replayStats is not None:
+            self.manager.show_replay_summary(self.cmds.replayStats)
+        elif self.cmds.stats is not None:
+            self.manager.show_stats(self.cmds.stats)
+        elif self.cmds.showRanks:
+            self.manager.show_ranks(tsv=False)
+        else:
+            self.manager.show_ranks(tsv=True)
+        return True
 
     def act(self):
         print ('Using database %s' % self.cmds.db_filename)
+        if self.read_only_command() and self.act_read_only():
+            return
         self.manager = Manager(halite_command, self.cmds.db_filename)
 
+        if self.cmds.replayCompression != "gzip":
+            try:
+                self.manager.replay_store = ReplayStore(replay_dir, self.cmds.replayCompression)
+                print("replay_compression = %s" % self.cmds.replayCompression)
+            except ImportError as e:
+                print("%s; compressing replays with gzip" % e)
+
+        if self.cmds.jobs > 1:
+            print("jobs = %d" % self.cmds.jobs)
+            self.manager.jobs = self.cmds.jobs
+
+        if self.cmds.pinCpus:
+            if CpuAllocator.available():
+                self.manager.cpu_allocator = CpuAllocator()
+                print("pin_cpus = %s" % ",".join(str(cpu) for cpu in self.manager.cpu_allocator.cpus))
+            else:
+                print("CPU pinning is not supported on this platform, ignoring --pin-cpus")
+
+        if self.cmds.coordinator is not None and (self.cmds.match or self.cmds.forever):
+            self.manager.coordinator = start_coordinator(self.cmds.coordinator, self.cmds.leaseSeconds)
+
+        if self.cmds.groupCommit > 1:
+            print("group_commit = %d" % self.cmds.groupCommit)
+            self.manager.db.group_commit = self.cmds.groupCommit
+
         if self.cmds.deleteReplays:
             print("keep_replays = False")
             self.manager.keep_replays = False
             
         if self.cmds.equalPriority:
             print("priority_sigma = False")
-            self.manager.priority_sigma = False
+            self.manager.scheduler = SigmaScheduler(priority_sigma=False)
+
+        if self.cmds.ratingEngine != "fast":
+            print("rating_engine = %s" % self.cmds.ratingEngine)
+        self.manager.rating_engine = rating_engines[self.cmds.ratingEngine](beta=self.cmds.beta, tau=self.cmds.tau, draw_probability=self.cmds.drawProbability)
+
+        if self.cmds.scheduler == "quality":
+            try:
+                self.manager.scheduler = QualityScheduler()
+                print("scheduler = quality")
+            except ImportError:
+                print("The quality scheduler needs numpy (pip install numpy); using the default scheduler")
             
         if self.cmds.excludeInactive:
             print("exclude_inactive = True")
@@ -466,7 +2968,15 @@ class Commandline:
         if self.cmds.player_dist is None:
             self.cmds.player_dist = [2, 4] #[2] * 5 + [3] * 4 + [4] * 3 + [5] * 2 + [6] if self.cmds.seed_dist else [2] * 5 + [3] * 8 + [4] * 9 + [5] * 8 + [6] * 5
         print ('Using player distribution %s' % str(self.cmds.player_dist))
-        print ('Using map distribution %s' % str(self.cmds.map_dist))
+        print ('Using map distribution %s' % (str(self.cmds.map_dist) if self.cmds.map_dist else 'default'))
+
+        if self.cmds.corpus:
+            print ('Using a corpus of %d maps from seed %d' % (self.cmds.corpus, self.cmds.corpus_seed))
+            self.manager.load_corpus(self.cmds.corpus, self.cmds.corpus_seed, self.cmds.map_dist)
+
+        if self.cmds.cache_results:
+            print("cache_results = True")
+            self.manager.cache_results = True
 
         if self.cmds.addBot:
             print("Adding new bot...")
@@ -497,6 +3007,50 @@ class Commandline:
             print("Viewing replay %s" %(self.cmds.view))
             view_replay(self.cmds.view)
         
+        elif self.cmds.rerate:
+            print("Re-rating all bots from the stored game history...")
+            start = time.time()
+            games = self.manager.db.rerate(self.manager.rating_engine)
+            print("Re-rated %d games in %.1f seconds" % (games, time.time() - start))
+            self.manager.show_ranks()
+
+        elif self.cmds.rebuildStats:
+            print("Rebuilding the statistics tables from the stored game history...")
+            start = time.time()
+            games = self.manager.db.rebuild_stats(self.manager.rating_engine)
+            print("Rebuilt from %d games in %.1f seconds" % (games, time.time() - start))
+
+        elif self.cmds.benchmark:
+            run_benchmark(self.cmds.benchPools, self.cmds.benchMatches, self.cmds.benchOutput, self.cmds.player_dist, self.cmds.top)
+
+        elif self.cmds.benchStartup:
+            run_startup_benchmark(output=self.cmds.benchOutput)
+
+        elif self.cmds.checkRatings:
+            check_rating_engines()
+
+        elif self.cmds.checkReplays is not None:
+            check_replay_reader(self.cmds.checkReplays)
+
+        elif self.cmds.serveReplays is not None:
+            serve_replays(self.cmds.serveReplays)
+
+        elif self.cmds.pruneReplays:
+            deleted = self.manager.replay_store.prune(self.manager.db, self.cmds.keepDays, self.cmds.keepTop, self.cmds.keepUpsets)
+            print("Deleted %d replays" % deleted)
+
+        elif self.cmds.analyzeReplays:
+            analyze_replays(self.manager.db, self.cmds.jobs)
+
+        elif self.cmds.perf is not None:
+            self.manager.show_performance(self.cmds.perf)
+
+        elif self.cmds.replayStats is not None:
+            self.manager.show_replay_summary(self.cmds.replayStats)
+
+        elif self.cmds.stats is not None:
+            self.manager.show_stats(self.cmds.stats)
+
         elif self.cmds.showRanks:
             self.manager.show_ranks(tsv=False)
         
@@ -507,10 +3061,28 @@ class Commandline:
             print ("Running a single match.")
             self.run_matches(1)
         
+        elif self.cmds.headToHead:
+            print ("Playing %s against %s until the test is decided. Press any key to stop early." % tuple(self.cmds.headToHead))
+            self.run_head_to_head(*self.cmds.headToHead)
+
         elif self.cmds.forever:
-            print ("Running matches until interrupted. Press any key to exit safely at the end of the current match.")
+            print ("Running matches until interrupted. Press any key to exit safely at the end of the current match(es).")
             self.run_matches(-1)
 
+        elif self.cmds.worker:
+            import socket
+            name = self.cmds.workerName or "%s-%d" % (socket.gethostname(), os.getpid())
+            print ("Playing matches for %s as %s. Press Ctrl-C to stop." % (self.cmds.worker, name))
+            stager = BotStager(self.cmds.stageBots) if self.cmds.stageBots else None
+            workers = [threading.Thread(target=run_worker, args=(self.cmds.worker, halite_command, "%s/%d" % (name, i), stager), daemon=True) for i in range(self.cmds.jobs)]
+            for worker in workers:
+                worker.start()
+            try:
+                for worker in workers:
+                    worker.join()
+            except KeyboardInterrupt:
+                pass
+
         elif self.cmds.reset:
             print('You want to reset the database.  This is IRRECOVERABLE.  Make a backup first.')
             print('The existing bots names, paths, and activation status will be saved.')
@@ -528,21 +3100,123 @@ class Commandline:
             self.parser.print_help()
 
 
+class ReplayRequestHandler:
+    """ Serves the visualizer and streams replays straight from the archive: stored files go out
+    with sendfile, and compressed ones keep their compression when the browser accepts it.
+    serve_replays mixes it into http.server.BaseHTTPRequestHandler; http.server is only
+    imported then, which keeps it off the startup path of every other command. """
+    root = replay_dir
+    extra_files = set()
+    template = None
+    encodings = {".gz": "gzip", ".zst": "zstd"}
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path == "/" and "replay" in query:
+            self.send_page(query["replay"][0])
+        elif url.path == "/":
+            self.send_index()
+        elif url.path == "/replay" and "path" in query:
+            self.send_replay(query["path"][0])
+        elif url.path.startswith("/Visualizer_files/"):
+            self.send_static(os.path.join(self.root, url.path.lstrip("/")))
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+    def allowed(self, path):
+        real = os.path.realpath(path)
+        return real in self.extra_files or real.startswith(os.path.realpath(self.root) + os.sep)
+
+    def send_page(self, replay):
+        if ReplayRequestHandler.template is None:
+            with open(os.path.join(self.root, "Visualizer.htm")) as f:
+                visualizer = f.read()
+            loader = "function load_replay(url) { var r = new XMLHttpRequest(); r.open('GET', url, false); r.send(); return r.responseText; }\n      function init_vis() {"
+            ReplayRequestHandler.template = visualizer.replace("function init_vis() {", loader, 1).replace("'REPLAY_DATA'", "load_replay(REPLAY_URL)")
+        page = self.template.replace("REPLAY_URL", json.dumps("/replay?" + urllib.parse.urlencode({"path": replay})))
+        page = page.replace("'FILENAME'", json.dumps(os.path.basename(replay)))
+        self.send_bytes(page.encode(), "text/html; charset=utf-8")
+
+    def send_index(self):
+        import html
+        names = sorted((name for name in os.listdir(self.root) if ".hlt" in name), reverse=True)
+        links = "".join('<li><a href="/?%s">%s</a></li>' % (urllib.parse.urlencode({"replay": os.path.join(self.root, name)}), html.escape(name)) for name in names)
+        self.send_bytes(("<html><body><h3>Replays</h3><ul>%s</ul></body></html>" % links).encode(), "text/html; charset=utf-8")
+
+    def send_bytes(self, data, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_static(self, path):
+        if not self.allowed(path) or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        import mimetypes
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.send_file(path, content_type)
+
+    def send_replay(self, path):
+        if not self.allowed(path) or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        encoding = self.encodings.get(os.path.splitext(path)[1])
+        if encoding is None or encoding in self.headers.get("Accept-Encoding", ""):
+            self.send_file(path, "application/json", encoding)
+            return
+        # the browser can't take the stored encoding: decompress on the fly, in chunks
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        with ReplayStore.open(path) as f:
+            shutil.copyfileobj(f, self.wfile, ReplayStore.chunk_size)
+        self.close_connection = True
+
+    def send_file(self, path, content_type, encoding=None):
+        with open(path, 'rb') as f:
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            if encoding:
+                self.send_header("Content-Encoding", encoding)
+            self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            self.wfile.flush()
+            self.connection.sendfile(f)
+
+
+def serve_replays(port=0, filename=None):
+    """ Serve the replay archive on localhost; with a filename, open that replay in the browser """
+    if filename:
+        ReplayRequestHandler.extra_files.add(os.path.realpath(filename))
+    import http.server
+    handler = type("ReplayRequestHandler", (ReplayRequestHandler, http.server.BaseHTTPRequestHandler), {})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), handler)
+    url = "http://127.0.0.1:%d/" % server.server_address[1]
+    if filename:
+        url += "?" + urllib.parse.urlencode({"replay": filename})
+        Popen([browser_binary, url])
+    print("Serving replays at %s (press Ctrl-C to stop)" % url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
 def view_replay(filename):
-    output_filename = filename.replace(".hlt", ".htm")
-    if not os.path.exists(output_filename):
-        with open(filename, 'r') as f:
-            replay_data = f.read()
-        with open("replays/Visualizer.htm") as f:
-            html = f.read()
-        html = html.replace("FILENAME", filename)
-        html = html.replace("REPLAY_DATA", replay_data)
-        with open(output_filename, 'w') as f:
-            f.write(html)
-    call ([browser_binary, output_filename])
-
-
-cmdline = Commandline()
-cmdline.parse(sys.argv[1:])
-cmdline.act()
+    serve_replays(filename=filename)
+
+
+if __name__ == "__main__":
+    cmdline = Commandline()
+    cmdline.parse(sys.argv[1:])
+    cmdline.act()
 